@@ -0,0 +1,110 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy as np
+import tensorflow as tf
+import time
+
+import diff_enKF
+from dataloader import DataLoader
+
+'''
+compares the latency of one filter step (test) and one training step
+(forward + losses + updates) of enKFMLP when run eagerly, as a tf.function
+graph and compiled with XLA, and the frame rate of streaming inference with
+and without the sensor encoding pipelined ahead of the filter (StreamRunner),
+everything is run on the CPU
+'''
+def benchmark(mode, batch_size, num_ensemble, dim_x, steps):
+    tf.keras.backend.clear_session()
+    model = diff_enKF.enKFMLP(batch_size, num_ensemble, dropout_rate)
+    optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
+    sensor_spec = tf.TensorSpec([batch_size, 224, 224, 3], tf.float32)
+    filter_step = diff_enKF.FilterStep(model, optimizer, sensor_spec, jit_compile=(mode == 'xla'))
+    if mode == 'eager':
+        train_step = filter_step.train
+        test_step = filter_step.test
+    else:
+        train_step = filter_step.train_step
+        test_step = filter_step.test_step
+
+    raw_sensor = tf.random.uniform([batch_size, 224, 224, 3])
+    gt_now = tf.random.normal([batch_size, 1, dim_x])
+    states = DataLoader.format_state(gt_now, batch_size, num_ensemble, dim_x)
+
+    result = {}
+    for name, step in [('test', lambda: test_step(raw_sensor, states)),
+                       ('train', lambda: train_step(raw_sensor, states, gt_now))]:
+        # the first calls trace and compile
+        start = time.time()
+        for _ in range (warmup):
+            out = step()
+        tf.nest.map_structure(np.array, out)
+        first = time.time() - start
+        times = []
+        for _ in range (steps):
+            start = time.time()
+            out = step()
+            tf.nest.map_structure(np.array, out)
+            times.append(time.time() - start)
+        result[name] = (first, np.median(times), np.percentile(times, 90))
+    return result
+
+def benchmark_stream(batch_size, num_ensemble, dim_x, steps):
+    '''
+    frames per second of streaming inference, one test_step per frame against
+    StreamRunner, which encodes the next frames while the filter updates
+    '''
+    tf.keras.backend.clear_session()
+    model = diff_enKF.enKFMLP(batch_size, num_ensemble, dropout_rate)
+    sensor_spec = tf.TensorSpec([batch_size, 224, 224, 3], tf.float32)
+    filter_step = diff_enKF.FilterStep(model, None, sensor_spec)
+
+    frames = [tf.random.uniform([batch_size, 224, 224, 3]) for _ in range (steps)]
+    gt_now = tf.random.normal([batch_size, 1, dim_x])
+    states = DataLoader.format_state(gt_now, batch_size, num_ensemble, dim_x)
+
+    # the first calls trace
+    for _ in range (warmup):
+        np.array(filter_step.test_step(frames[0], states)[1])
+        np.array(filter_step.encoded_step(filter_step.encode(frames[0]), states)[1])
+
+    result = {}
+    start = time.time()
+    last = states
+    for raw_sensor in frames:
+        out = filter_step.test_step(raw_sensor, last)
+        last = (out[0], out[1])
+        np.array(out[1])
+    result['sequential'] = steps / (time.time() - start)
+
+    start = time.time()
+    for out in diff_enKF.StreamRunner(filter_step).run(frames, states):
+        np.array(out[1])
+    result['pipelined'] = steps / (time.time() - start)
+    return result
+
+global dropout_rate
+dropout_rate = 0.1
+
+global warmup
+warmup = 3
+
+def main():
+    tf.config.set_visible_devices([], 'GPU')
+    batch_size = 8
+    num_ensemble = 32
+    dim_x = 10
+    steps = 50
+    print('batch_size %d, num_ensemble %d, %d steps' % (batch_size, num_ensemble, steps))
+    for mode in ['eager', 'graph', 'xla']:
+        result = benchmark(mode, batch_size, num_ensemble, dim_x, steps)
+        for name in ['test', 'train']:
+            first, median, p90 = result[name]
+            print("%-5s %-5s: warmup %.3f s, median %.2f ms, p90 %.2f ms per step" %
+                  (mode, name, first, median*1e3, p90*1e3))
+    result = benchmark_stream(1, num_ensemble, dim_x, steps)
+    for name in ['sequential', 'pipelined']:
+        print("stream %-10s: %.1f frames/s at batch_size 1" % (name, result[name]))
+
+if __name__ == "__main__":
+    main()
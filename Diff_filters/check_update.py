@@ -0,0 +1,94 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy as np
+import tensorflow as tf
+
+import diff_enKF
+
+'''
+checks the ensemble updates of enKFMLP against the exact Kalman update,
+computed in numpy with float64, on random problems with a linear observation
+model z = H x and R = diag(diag_R) + U_R U_R^T:
+innovation_solve in 'dense' and in 'ensemble' (Woodbury) mode against a
+direct solve with the innovation matrix H P H^T + R of the ensemble covariance P,
+and transform_update (ETKF), whose ensemble mean and covariance have to match
+the Kalman mean and covariance update of the prior ensemble mean and covariance.
+every check raises an AssertionError when the relative error is above tol,
+everything is run on the CPU
+'''
+global tol
+tol = 1e-3
+
+def relative_error(a, b):
+    return np.abs(np.asarray(a, np.float64) - b).max() / np.abs(b).max()
+
+def random_problem(rng, batch_size, num_ensemble, dim_x, dim_z, rank):
+    X = rng.randn(batch_size, num_ensemble, dim_x)
+    H = rng.randn(batch_size, dim_z, dim_x)
+    diag_R = rng.rand(batch_size, dim_z) + 0.2
+    U_R = 0.5 * rng.randn(batch_size, dim_z, rank) if rank > 0 else None
+    return X, H, diag_R, U_R
+
+def check_innovation_solve(model, rng, num_ensemble, rank):
+    batch_size = 3
+    X, H, diag_R, U_R = random_problem(rng, batch_size, num_ensemble, model.dim_x, model.dim_z, rank)
+    HX = np.einsum('bzx,bnx->bnz', H, X)
+    H_A = HX - HX.mean(axis=1, keepdims=True)
+    y_bar = rng.randn(batch_size, model.dim_z, num_ensemble)
+
+    errors = {}
+    for update_mode in ['dense', 'ensemble']:
+        model.update_mode = update_mode
+        out = model.innovation_solve(tf.constant(H_A, tf.float32), tf.constant(diag_R, tf.float32),
+                                     tf.constant(y_bar, tf.float32),
+                                     None if U_R is None else tf.constant(U_R, tf.float32))
+        error = 0.
+        for i in range (batch_size):
+            P = np.cov(X[i].T)
+            R = np.diag(diag_R[i]) + (U_R[i] @ U_R[i].T if U_R is not None else 0.)
+            innovation = H[i] @ P @ H[i].T + R
+            error = max(error, relative_error(out[i], np.linalg.solve(innovation, y_bar[i])))
+        assert error < tol, (update_mode, num_ensemble, rank, error)
+        errors[update_mode] = error
+    return errors
+
+def check_transform_update(model, rng, num_ensemble, rank):
+    batch_size = 3
+    X, H, diag_R, U_R = random_problem(rng, batch_size, num_ensemble, model.dim_x, model.dim_z, rank)
+    HX = np.einsum('bzx,bnx->bnz', H, X)
+    z = rng.randn(batch_size, model.dim_z)
+    out = model.transform_update(tf.constant(X, tf.float32), tf.constant(HX, tf.float32),
+                                 tf.constant(z, tf.float32),
+                                 None if U_R is None else tf.constant(U_R, tf.float32),
+                                 tf.constant(diag_R, tf.float32))
+    out = np.asarray(out, np.float64)
+    error_m, error_P = 0., 0.
+    for i in range (batch_size):
+        m = X[i].mean(axis=0)
+        P = np.cov(X[i].T)
+        R = np.diag(diag_R[i]) + (U_R[i] @ U_R[i].T if U_R is not None else 0.)
+        K = P @ H[i].T @ np.linalg.inv(H[i] @ P @ H[i].T + R)
+        m_new = m + K @ (z[i] - H[i] @ m)
+        P_new = (np.eye(model.dim_x) - K @ H[i]) @ P
+        error_m = max(error_m, relative_error(out[i].mean(axis=0), m_new))
+        error_P = max(error_P, relative_error(np.cov(out[i].T), P_new))
+    assert error_m < tol and error_P < tol, (num_ensemble, rank, error_m, error_P)
+    return error_m, error_P
+
+def main():
+    tf.config.set_visible_devices([], 'GPU')
+    rng = np.random.RandomState(0)
+    model = diff_enKF.enKFMLP(1, 8, 0.1)
+    for num_ensemble in [4, 8, 32]:
+        for rank in [0, 2]:
+            errors = check_innovation_solve(model, rng, num_ensemble, rank)
+            print('innovation_solve num_ensemble %2d rank %d: dense %.1e, ensemble %.1e' %
+                  (num_ensemble, rank, errors['dense'], errors['ensemble']))
+    for num_ensemble in [4, 8, 32]:
+        for rank in [0, 2]:
+            error_m, error_P = check_transform_update(model, rng, num_ensemble, rank)
+            print('transform_update num_ensemble %2d rank %d: mean %.1e, covariance %.1e' %
+                  (num_ensemble, rank, error_m, error_P))
+
+if __name__ == "__main__":
+    main()
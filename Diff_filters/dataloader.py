@@ -12,321 +12,502 @@ import pdb
 import tensorflow_probability as tfp
 import csv
 import cv2
+import queue
+import threading
+import shutil
+import multiprocessing
+import atexit
+
+# state of a decode worker process, see DecodePool
+_worker = {}
+
+def _init_decode_worker(buffer, func, shape, dtype, num_slots):
+    cv2.setNumThreads(0)
+    _worker['slots'] = np.frombuffer(buffer, dtype=dtype).reshape((num_slots,) + tuple(shape))
+    _worker['func'] = func
+
+def _decode(slot, item):
+    _worker['slots'][slot] = _worker['func'](item)
+
+class DecodePool:
+    '''
+    decodes/preprocesses images in num_workers processes with func, the workers
+    write their results into a shared memory buffer instead of sending pickled
+    arrays back. the buffer holds num_blocks blocks of block_size images,
+    every call of map works on its own block, so the pool can be shared by
+    several loader threads. once closed, map decodes in the calling thread
+    '''
+    def __init__(self, func, shape, dtype, num_workers, block_size=64, num_blocks=4):
+        self.func = func
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        num_slots = block_size * num_blocks
+        buffer = multiprocessing.RawArray('b', num_slots * int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.slots = np.frombuffer(buffer, dtype=self.dtype).reshape((num_slots,) + self.shape)
+        self.free_blocks = queue.Queue()
+        for block in range (num_blocks):
+            self.free_blocks.put(block)
+        self.pool = multiprocessing.Pool(num_workers, initializer=_init_decode_worker,
+                                         initargs=(buffer, func, self.shape, self.dtype.str, num_slots))
+        self.closed = False
+        # close before multiprocessing tears the workers down at exit, otherwise
+        # loader threads that are still waiting on the pool never return
+        atexit.register(self.close)
+
+    def map(self, items):
+        out = np.empty((len(items),) + self.shape, dtype=self.dtype)
+        if self.closed:
+            for i, item in enumerate(items):
+                out[i] = self.func(item)
+            return out
+        block = self.free_blocks.get()
+        try:
+            offset = block * self.block_size
+            for start in range (0, len(items), self.block_size):
+                chunk = items[start:start + self.block_size]
+                result = self.pool.starmap_async(_decode, [(offset + i, item) for i, item in enumerate(chunk)])
+                while not result.ready():
+                    if self.closed:
+                        raise RuntimeError('the decode pool has been closed')
+                    result.wait(1.0)
+                result.get()
+                out[start:start + len(chunk)] = self.slots[offset:offset + len(chunk)]
+        finally:
+            self.free_blocks.put(block)
+        return out
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.terminate()
+            self.pool.join()
+            # the exit hook would keep the pool and its buffer alive until exit
+            atexit.unregister(self.close)
+
+class EpochSampler:
+    '''
+    hands out training indices one batch at a time, every epoch is a fresh
+    permutation of the dataset drawn from seed + epoch, so the batches are
+    reproducible and can be resumed from a step counter.
+    behind a prefetching tf.data pipeline self.step runs ahead of the batches
+    the training loop has used, to resume exactly pass the number of batches
+    the loop has consumed as step, not sampler.step
+    '''
+    def __init__(self, N, batch_size, seed=0, step=0):
+        self.N = N
+        self.batch_size = batch_size
+        self.seed = seed
+        self.step = step
+        if N < batch_size:
+            raise ValueError('the dataset has %d entries, fewer than one batch of %d' % (N, batch_size))
+        # the last incomplete batch of every epoch is dropped
+        self.steps_per_epoch = N // batch_size
+        self.epoch = None
+        self.perm = None
+
+    def permutation(self, epoch):
+        if epoch != self.epoch:
+            self.perm = np.random.RandomState(self.seed + epoch).permutation(self.N)
+            self.epoch = epoch
+        return self.perm
+
+    def next(self):
+        epoch, k = divmod(self.step, self.steps_per_epoch)
+        select = self.permutation(epoch)[k*self.batch_size:(k+1)*self.batch_size]
+        self.step = self.step + 1
+        # sorted, so that the block is read front to back from the stores
+        return np.sort(select)
+
+    def __iter__(self):
+        while True:
+            yield self.next()
 
 class DataLoader:
     # for high dimensional data
     #       state -> [time, batch_size, 1, 7] or [time, batch_size, 1, 3]
     # observation -> [time, batch_size, height, width, 3]
-    def load_train_data_joint(csv_path, batch_size):
+    #
+    # csv columns: 1 -> joint pre, 2 -> joint gt, 3 -> EE pre, 4 -> EE gt, 5 -> image path
+    # the csv is parsed once into a columnar cache, see build_cache/load_cache
+    # the preprocessed images can be stored as uint8 shards, see build_image_store
+    _cache = {}
+    _image_store = {}
+    _image_store_lock = threading.Lock()
+    # worker processes for decoding the images, see set_decode_workers
+    decode_pool = None
+    # cache columns that make up the (pre, gt) states of each mode
+    modes = {'joint': (['joint_pre'], ['joint_gt']),
+             'EE': (['EE_pre'], ['EE_gt']),
+             'All': (['joint_pre', 'EE_pre'], ['joint_gt', 'EE_gt'])}
+
+    def build_cache(csv_path):
+        '''
+        parse the csv once and save every column as a contiguous array
+        into <csv name>_cache.npz next to the csv
+        '''
         dataset = []
         with open(csv_path,'rt')as f:
             data = csv.reader(f)
             for row in data:
                 dataset.append(row)
-        N = len(dataset)
-        select = random.sample(range(0, N), batch_size)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in select:
-            arr = dataset[idx][1][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][2][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        # to tensor
-        states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [batch_size, 1, 7])
-
-        states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [batch_size, 1, 7])
-
-        observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
-        return states_pre_save, states_gt_save, observation_save
-
-    def load_train_data_EE(csv_path, batch_size):
-        dataset = []
-        with open(csv_path,'rt')as f:
-            data = csv.reader(f)
-            for row in data:
-                dataset.append(row)
-        N = len(dataset)
-        select = random.sample(range(0, N), batch_size)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in select:
-            arr = dataset[idx][3][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][4][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        # to tensor
-        states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [batch_size, 1, 3])
-
-        states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [batch_size, 1, 3])
-
-        observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
-        return states_pre_save, states_gt_save, observation_save
-
-    def load_test_data_joint(csv_path, batch_size):
-        dataset = []
-        with open(csv_path,'rt')as f:
-            data = csv.reader(f)
-            for row in data:
-                dataset.append(row)
-        N = len(dataset)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in range(N):
-            arr = dataset[idx][1][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][2][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        # to tensor
-        states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [N, batch_size, 1, 7])
-
-        states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [N, batch_size, 1, 7])
-
-        observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
-        observation_save = tf.expand_dims(observation_save, axis=1)
-        return states_pre_save, states_gt_save, observation_save
-
-    def load_test_data_EE(csv_path, batch_size):
-        dataset = []
-        with open(csv_path,'rt')as f:
-            data = csv.reader(f)
-            for row in data:
-                dataset.append(row)
-        N = len(dataset)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in range(N):
-            arr = dataset[idx][3][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][4][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        # to tensor
-        states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [N, batch_size, 1, 3])
-
-        states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [N, batch_size, 1, 3])
-
-        observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
-        observation_save = tf.expand_dims(observation_save, axis=1)
-        return states_pre_save, states_gt_save, observation_save
+        columns = {'joint_pre': 1, 'joint_gt': 2, 'EE_pre': 3, 'EE_gt': 4}
+        cache = {}
+        for key, col in columns.items():
+            cache[key] = DataLoader.parse_array_column([row[col] for row in dataset])
+        cache['img_path'] = np.array([row[5] for row in dataset])
+        cache_path = os.path.splitext(csv_path)[0] + '_cache.npz'
+        # written under a temporary name and moved into place, so an interrupted
+        # write never leaves a cache that looks newer than the csv
+        tmp_path = cache_path + '.tmp' + str(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **cache)
+        os.replace(tmp_path, cache_path)
+        return cache
+
+    def parse_array_column(column):
+        '''
+        decode a whole column of array strings like "[0.1 0.2 ...]" into a
+        float32 matrix [num_rows, dim] with a single numpy conversion,
+        every row has to be bracketed and hold the same number of values
+        '''
+        column = np.char.strip(np.array(column, dtype=str))
+        bracketed = np.char.startswith(column, '[') & np.char.endswith(column, ']')
+        if not np.all(bracketed):
+            idx = int(np.argmin(bracketed))
+            raise ValueError('row %d is not a bracketed array: %r' % (idx, column[idx]))
+        tokens = [row.split() for row in np.char.strip(column, '[]')]
+        N = len(tokens)
+        dim = len(tokens[0]) if N > 0 else 0
+        lengths = np.array([len(row) for row in tokens], dtype=np.int64)
+        if np.any(lengths != dim):
+            idx = int(np.argmax(lengths != dim))
+            raise ValueError('row %d has %d values, expected %d' % (idx, lengths[idx], dim))
+        try:
+            values = np.array([x for row in tokens for x in row], dtype=np.float32)
+        except ValueError:
+            for idx, row in enumerate(tokens):
+                try:
+                    np.array(row, dtype=np.float32)
+                except ValueError:
+                    raise ValueError('row %d has a non numeric value: %r' % (idx, column[idx]))
+            raise
+        return values.reshape([N, dim])
+
+    def load_cache(csv_path):
+        '''
+        returns the columnar cache of the csv, the cache file is (re)built
+        when it is missing or older than the csv, and kept in memory afterwards
+        '''
+        if csv_path not in DataLoader._cache:
+            cache_path = os.path.splitext(csv_path)[0] + '_cache.npz'
+            if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(csv_path):
+                with np.load(cache_path) as data:
+                    cache = {key: data[key] for key in data.files}
+            else:
+                cache = DataLoader.build_cache(csv_path)
+            DataLoader._cache[csv_path] = cache
+        return DataLoader._cache[csv_path]
+
+    def read_image(path):
+        img_array = cv2.imread('./dataset'+path)
+        img_array = cv2.resize(img_array, (224, 224))
+        img_array = cv2.flip(img_array, 0) # flip the img vertically
+        return img_array
+
+    def set_decode_workers(num_workers, block_size=64):
+        '''
+        decode the images in num_workers processes from now on,
+        0 goes back to decoding in the calling thread
+        '''
+        if DataLoader.decode_pool is not None:
+            DataLoader.decode_pool.close()
+            DataLoader.decode_pool = None
+        if num_workers > 0:
+            DataLoader.decode_pool = DecodePool(DataLoader.read_image, (224, 224, 3), np.uint8,
+                                                num_workers, block_size)
+
+    def read_images(img_paths):
+        if DataLoader.decode_pool is not None:
+            return DataLoader.decode_pool.map(list(img_paths))
+        return np.array([DataLoader.read_image(path) for path in img_paths], dtype=np.uint8)
+
+    def load_images(img_paths):
+        observation_save = DataLoader.read_images(img_paths)
+        return (observation_save/255.0)
+
+    def build_image_store(csv_path, shard_size=1024):
+        '''
+        preprocess every image of the csv once (resize + flip) and write them
+        into uint8 shards of shape [shard_size, 224, 224, 3] under
+        <csv name>_images/, row idx lives in shard idx // shard_size.
+        the shards are written into a temporary directory that only replaces
+        <csv name>_images/ once every shard is complete
+        '''
+        cache = DataLoader.load_cache(csv_path)
+        store_path = os.path.splitext(csv_path)[0] + '_images'
+        tmp_path = store_path + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        N = cache['img_path'].shape[0]
+        for k in range (int(math.ceil(N / shard_size))):
+            shard = np.lib.format.open_memmap(
+                os.path.join(tmp_path, 'shard_'+str(k).zfill(5)+'.npy'),
+                mode='w+', dtype=np.uint8, shape=(shard_size, 224, 224, 3))
+            img_paths = cache['img_path'][k*shard_size:(k+1)*shard_size]
+            shard[:len(img_paths)] = DataLoader.read_images(img_paths)
+            shard.flush()
+            del shard
+        if os.path.exists(store_path):
+            shutil.rmtree(store_path)
+        os.replace(tmp_path, store_path)
+        return store_path
+
+    def load_image_store(csv_path):
+        '''
+        returns the memory-mapped image shards of the csv, the store is (re)built
+        when it is missing or older than the csv. the lock keeps loader threads
+        from building it twice or listing a store that is being replaced,
+        train_dataset still resolves it once before its threads start
+        '''
+        with DataLoader._image_store_lock:
+            if csv_path not in DataLoader._image_store:
+                store_path = os.path.splitext(csv_path)[0] + '_images'
+                if not (os.path.exists(store_path) and
+                        os.path.getmtime(store_path) >= os.path.getmtime(csv_path)):
+                    DataLoader.build_image_store(csv_path)
+                files = sorted(f for f in os.listdir(store_path) if f.startswith('shard_'))
+                shards = [np.load(os.path.join(store_path, f), mmap_mode='r') for f in files]
+                DataLoader._image_store[csv_path] = shards
+            return DataLoader._image_store[csv_path]
+
+    def load_observations(csv_path, select, image_store):
+        '''
+        images of the selected rows, either decoded from the image files or
+        sliced out of the uint8 image store and normalized as float32
+        '''
+        if not image_store:
+            cache = DataLoader.load_cache(csv_path)
+            return DataLoader.load_images(cache['img_path'][select])
+        return DataLoader.read_image_store(DataLoader.load_image_store(csv_path), select)
+
+    def read_image_store(shards, select):
+        '''
+        the selected rows of the memory-mapped shards from load_image_store,
+        normalized as float32
+        '''
+        shard_size = shards[0].shape[0]
+        select = np.asarray(select)
+        observation_save = np.empty((select.shape[0], 224, 224, 3), dtype=np.uint8)
+        for k in np.unique(select // shard_size):
+            pos = np.nonzero(select // shard_size == k)[0]
+            observation_save[pos] = shards[k][select[pos] % shard_size]
+        return observation_save.astype(np.float32) / 255.
+
+    def load_states(cache, select, keys):
+        arr = [cache[key][select] for key in keys]
+        return np.concatenate(arr, axis=-1)
+
+    def load_train_data(csv_path, batch_size, keys_pre, keys_gt, image_store=False, sampler=None):
+        cache = DataLoader.load_cache(csv_path)
+        N = cache['img_path'].shape[0]
+        if sampler is None:
+            select = random.sample(range(0, N), batch_size)
+        else:
+            select = sampler.next()
+        states_pre_save = DataLoader.load_states(cache, select, keys_pre)
+        states_gt_save = DataLoader.load_states(cache, select, keys_gt)
+        observation_save = DataLoader.load_observations(csv_path, select, image_store)
+        dim_x = states_pre_save.shape[-1]
 
-    def load_train_data_All(csv_path, batch_size):
-        dataset = []
-        with open(csv_path,'rt')as f:
-            data = csv.reader(f)
-            for row in data:
-                dataset.append(row)
-        N = len(dataset)
-        select = random.sample(range(0, N), batch_size)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in select:
-            arr = dataset[idx][1][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            arr_tmp = dataset[idx][3][1:-1].split()
-            arr_tmp = [eval(x) for x in arr_tmp]
-            arr_tmp = np.array(arr_tmp)
-
-            arr = np.concatenate((arr, arr_tmp), axis=None)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][2][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            arr_tmp = dataset[idx][4][1:-1].split()
-            arr_tmp = [eval(x) for x in arr_tmp]
-            arr_tmp = np.array(arr_tmp)
-            arr = np.concatenate((arr, arr_tmp), axis=None)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
         # to tensor
         states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [batch_size, 1, 10])
+        states_pre_save = tf.reshape(states_pre_save, [batch_size, 1, dim_x])
 
         states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [batch_size, 1, 10])
+        states_gt_save = tf.reshape(states_gt_save, [batch_size, 1, dim_x])
 
         observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
         return states_pre_save, states_gt_save, observation_save
 
-    def load_test_data_All(csv_path, batch_size):
-        dataset = []
-        with open(csv_path,'rt')as f:
-            data = csv.reader(f)
-            for row in data:
-                dataset.append(row)
-        N = len(dataset)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        for idx in range(N):
-            arr = dataset[idx][1][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            arr_tmp = dataset[idx][3][1:-1].split()
-            arr_tmp = [eval(x) for x in arr_tmp]
-            arr_tmp = np.array(arr_tmp)
-
-            arr = np.concatenate((arr, arr_tmp), axis=None)
-            states_pre_save.append(arr)
-
-            arr = dataset[idx][2][1:-1].split()
-            arr = [eval(x) for x in arr]
-            arr = np.array(arr)
-            arr_tmp = dataset[idx][4][1:-1].split()
-            arr_tmp = [eval(x) for x in arr_tmp]
-            arr_tmp = np.array(arr_tmp)
-            arr = np.concatenate((arr, arr_tmp), axis=None)
-            states_gt_save.append(arr)
-
-            img_path = './dataset'+dataset[idx][5]
-            img_array = cv2.imread(img_path)
-            img_array = cv2.resize(img_array, (224, 224))
-            img_array = cv2.flip(img_array, 0) # flip the img vertically
-            img_array = (img_array/255.0)
-            observation_save.append(img_array)
-
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-
-        print(states_pre_save.shape)
+    def load_test_data(csv_path, batch_size, keys_pre, keys_gt, image_store=False):
+        cache = DataLoader.load_cache(csv_path)
+        N = cache['img_path'].shape[0]
+        select = np.arange(N)
+        states_pre_save = DataLoader.load_states(cache, select, keys_pre)
+        states_gt_save = DataLoader.load_states(cache, select, keys_gt)
+        observation_save = DataLoader.load_observations(csv_path, select, image_store)
+        dim_x = states_pre_save.shape[-1]
 
         # to tensor
         states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
-        states_pre_save = tf.reshape(states_pre_save, [N, batch_size, 1, 10])
+        states_pre_save = tf.reshape(states_pre_save, [N, batch_size, 1, dim_x])
 
         states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
-        states_gt_save = tf.reshape(states_gt_save, [N, batch_size, 1, 10])
+        states_gt_save = tf.reshape(states_gt_save, [N, batch_size, 1, dim_x])
 
         observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
         observation_save = tf.expand_dims(observation_save, axis=1)
         return states_pre_save, states_gt_save, observation_save
 
-
-
-    def format_state(state, batch_size, num_ensemble, dim_x):
-        dim_x = dim_x
-        diag = np.ones((dim_x)).astype(np.float32) * 0.1
-        diag = diag.astype(np.float32)
-        mean = np.zeros((dim_x))
-        mean = tf.convert_to_tensor(mean, dtype=tf.float32)
-        mean = tf.stack([mean] * batch_size)
-        nd = tfp.distributions.MultivariateNormalDiag(loc=mean, scale_diag=diag)
-        Q = tf.reshape(nd.sample(num_ensemble), [batch_size, num_ensemble, dim_x])
-        for n in range (batch_size):
-            if n == 0:
-                ensemble = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-                ensemble = tf.concat([ensemble, tmp], 0)
-        ensemble = ensemble + Q
+    def stream_test_data(csv_path, batch_size, keys_pre, keys_gt, image_store=False, window=1, read_ahead=8):
+        '''
+        lazy version of load_test_data, yields (states_pre, states_gt, observation)
+        one timestep at a time, shaped like the [t] slices of load_test_data,
+        or window timesteps at a time, shaped like the [t:t+window] slices.
+        a background thread reads at most read_ahead windows ahead of the filter,
+        an error while reading is raised in the consumer, and if the consumer
+        stops early the reader is stopped and joined as well
+        '''
+        cache = DataLoader.load_cache(csv_path)
+        N = cache['img_path'].shape[0]
+        buffer = queue.Queue(maxsize=read_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up once the consumer is gone instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read():
+            try:
+                for t in range (0, N, window):
+                    select = np.arange(t, min(t + window, N))
+                    states_pre_save = DataLoader.load_states(cache, select, keys_pre)
+                    states_gt_save = DataLoader.load_states(cache, select, keys_gt)
+                    observation_save = DataLoader.load_observations(csv_path, select, image_store)
+                    if not put((states_pre_save, states_gt_save, observation_save)):
+                        return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                states_pre_save, states_gt_save, observation_save = item
+                T = states_pre_save.shape[0]
+                dim_x = states_pre_save.shape[-1]
+
+                # to tensor
+                states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
+                states_pre_save = tf.reshape(states_pre_save, [T, batch_size, 1, dim_x])
+
+                states_gt_save = tf.convert_to_tensor(states_gt_save, dtype=tf.float32)
+                states_gt_save = tf.reshape(states_gt_save, [T, batch_size, 1, dim_x])
+
+                observation_save = tf.convert_to_tensor(observation_save, dtype=tf.float32)
+                observation_save = tf.expand_dims(observation_save, axis=1)
+                if window == 1:
+                    yield states_pre_save[0], states_gt_save[0], observation_save[0]
+                else:
+                    yield states_pre_save, states_gt_save, observation_save
+        finally:
+            stop.set()
+            reader.join()
+
+    def train_dataset(csv_path, batch_size, mode='All', image_store=False, sampler=None):
+        '''
+        tf.data pipeline over the training csv that yields the same
+        (states_pre, states_gt, observation) batches as load_train_data_<mode>,
+        batches are decoded in parallel and prefetched while the filter runs,
+        the indices of each batch come from sampler (an EpochSampler)
+        '''
+        keys_pre, keys_gt = DataLoader.modes[mode]
+        cache = DataLoader.load_cache(csv_path)
+        N = cache['img_path'].shape[0]
+        states_pre = DataLoader.load_states(cache, np.arange(N), keys_pre)
+        states_gt = DataLoader.load_states(cache, np.arange(N), keys_gt)
+        dim_x = states_pre.shape[-1]
+        states_pre = tf.reshape(tf.convert_to_tensor(states_pre, dtype=tf.float32), [N, 1, dim_x])
+        states_gt = tf.reshape(tf.convert_to_tensor(states_gt, dtype=tf.float32), [N, 1, dim_x])
+
+        if image_store:
+            # resolved once here, not by the parallel map threads
+            shards = DataLoader.load_image_store(csv_path)
+            read = lambda idx: DataLoader.read_image_store(shards, idx)
+        else:
+            read = lambda idx: DataLoader.load_images(cache['img_path'][idx])
+
+        def load_batch(select):
+            observation = tf.numpy_function(
+                lambda idx: read(idx).astype(np.float32),
+                [select], tf.float32)
+            observation.set_shape([batch_size, 224, 224, 3])
+            return tf.gather(states_pre, select), tf.gather(states_gt, select), observation
+
+        if sampler is None:
+            sampler = EpochSampler(N, batch_size)
+        dataset = tf.data.Dataset.from_generator(
+            lambda: iter(sampler), output_types=tf.int64, output_shapes=[batch_size])
+        dataset = dataset.map(load_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        return dataset
+
+    def load_train_data_joint(csv_path, batch_size, image_store=False, sampler=None):
+        return DataLoader.load_train_data(csv_path, batch_size, ['joint_pre'], ['joint_gt'], image_store, sampler)
+
+    def load_train_data_EE(csv_path, batch_size, image_store=False, sampler=None):
+        return DataLoader.load_train_data(csv_path, batch_size, ['EE_pre'], ['EE_gt'], image_store, sampler)
+
+    def load_train_data_All(csv_path, batch_size, image_store=False, sampler=None):
+        return DataLoader.load_train_data(csv_path, batch_size, ['joint_pre', 'EE_pre'], ['joint_gt', 'EE_gt'], image_store, sampler)
+
+    def load_test_data_joint(csv_path, batch_size, image_store=False):
+        return DataLoader.load_test_data(csv_path, batch_size, ['joint_pre'], ['joint_gt'], image_store)
+
+    def load_test_data_EE(csv_path, batch_size, image_store=False):
+        return DataLoader.load_test_data(csv_path, batch_size, ['EE_pre'], ['EE_gt'], image_store)
+
+    def load_test_data_All(csv_path, batch_size, image_store=False):
+        return DataLoader.load_test_data(csv_path, batch_size, ['joint_pre', 'EE_pre'], ['joint_gt', 'EE_gt'], image_store)
+
+    def stream_test_data_joint(csv_path, batch_size, image_store=False, window=1, read_ahead=8):
+        return DataLoader.stream_test_data(csv_path, batch_size, ['joint_pre'], ['joint_gt'], image_store, window, read_ahead)
+
+    def stream_test_data_EE(csv_path, batch_size, image_store=False, window=1, read_ahead=8):
+        return DataLoader.stream_test_data(csv_path, batch_size, ['EE_pre'], ['EE_gt'], image_store, window, read_ahead)
+
+    def stream_test_data_All(csv_path, batch_size, image_store=False, window=1, read_ahead=8):
+        return DataLoader.stream_test_data(csv_path, batch_size, ['joint_pre', 'EE_pre'], ['joint_gt', 'EE_gt'], image_store, window, read_ahead)
+
+    def format_state(state, batch_size, num_ensemble, dim_x, spread=None):
+        '''
+        ensemble of num_ensemble copies of state [batch, 1, dim_x] perturbed by
+        gaussian noise with per dimension std spread (scalar or [dim_x]),
+        built by broadcasting, so it also works inside a tf.function
+        '''
+        if spread is None:
+            spread = 0.1
+        spread = tf.cast(spread, tf.float32) * tf.ones([dim_x])
+        state = tf.reshape(tf.cast(state, tf.float32), [-1, 1, dim_x])
+        Q = tf.random.normal([tf.shape(state)[0], num_ensemble, dim_x]) * spread
+        ensemble = tf.tile(state, [1, num_ensemble, 1]) + Q
         state_input = (ensemble, state)
         return state_input
 
-    def format_init_state(state, batch_size, num_ensemble, dim_x):
-        dim_x = dim_x
-        diag = np.ones((dim_x)).astype(np.float32) * 0.01
-        diag = diag.astype(np.float32)
-        mean = np.zeros((dim_x))
-        mean = tf.convert_to_tensor(mean, dtype=tf.float32)
-        mean = tf.stack([mean] * batch_size)
-        nd = tfp.distributions.MultivariateNormalDiag(loc=mean, scale_diag=diag)
-        Q = tf.reshape(nd.sample(num_ensemble), [batch_size, num_ensemble, dim_x])
-        for n in range (batch_size):
-            if n == 0:
-                ensemble = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-                ensemble = tf.concat([ensemble, tmp], 0)
-        ensemble = ensemble + Q
+    def format_init_state(state, batch_size, num_ensemble, dim_x, spread=None):
+        '''
+        same as format_state, with a smaller default spread for the test runs
+        '''
+        if spread is None:
+            spread = 0.01
+        spread = tf.cast(spread, tf.float32) * tf.ones([dim_x])
+        state = tf.reshape(tf.cast(state, tf.float32), [-1, 1, dim_x])
+        Q = tf.random.normal([tf.shape(state)[0], num_ensemble, dim_x]) * spread
+        ensemble = tf.tile(state, [1, num_ensemble, 1]) + Q
         state_input = (ensemble, state)
         return state_input
 
@@ -342,3 +523,18 @@ class DataLoader:
 
 
 
+
+
+    def pad_trajectories(trajectories):
+        '''
+        packs trajectories of different lengths, each [T_i, ...], into one
+        batch [T_max, num_trajectories, ...] for FilterStep.masked_rollout,
+        the short ones are padded with their last step,
+        mask [T_max, num_trajectories] is False on the padded steps
+        '''
+        trajectories = [np.asarray(traj) for traj in trajectories]
+        T = max(traj.shape[0] for traj in trajectories)
+        padded = np.stack([np.concatenate([traj, np.repeat(traj[-1:], T - traj.shape[0], axis=0)])
+                           for traj in trajectories], axis=1)
+        mask = np.stack([np.arange(T) < traj.shape[0] for traj in trajectories], axis=1)
+        return padded, mask
@@ -29,6 +29,8 @@ import tensorflow as tf
 import time
 import pickle
 import pdb
+import queue
+import threading
 from tensorflow.compat.v1 import ConfigProto
 from tensorflow.compat.v1 import InteractiveSession
 import tensorflow_probability as tfp
@@ -98,7 +100,8 @@ class ProcessModel(tf.keras.Model):
             name='process_fc3')
 
     def call(self, last_state, training):
-        last_state = tf.reshape(last_state, [self.batch_size * self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(last_state)[1]
+        last_state = tf.reshape(last_state, [-1, self.dim_x])
 
         fc1 = self.process_fc1(last_state)
         # fc1 = tf.nn.dropout(fc1, rate=self.rate)
@@ -111,7 +114,7 @@ class ProcessModel(tf.keras.Model):
         update = self.process_fc3(fcadd2)
 
         new_state = last_state + update
-        new_state = tf.reshape(new_state, [self.batch_size, self.num_ensemble, self.dim_x])
+        new_state = tf.reshape(new_state, [-1, num_ensemble, self.dim_x])
 
         return new_state
 
@@ -155,7 +158,8 @@ class BayesianProcessModel(tf.keras.Model):
             name='process_fc3')
 
     def call(self, last_state, training):
-        last_state = tf.reshape(last_state, [self.batch_size * self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(last_state)[1]
+        last_state = tf.reshape(last_state, [-1, self.dim_x])
 
         fc1 = self.process_fc1(last_state)
         fcadd1 = self.process_fc_add1(fc1)
@@ -166,7 +170,7 @@ class BayesianProcessModel(tf.keras.Model):
         update = self.process_fc3(fcadd2)
 
         new_state = last_state + update
-        new_state = tf.reshape(new_state, [self.batch_size, self.num_ensemble, self.dim_x])
+        new_state = tf.reshape(new_state, [-1, num_ensemble, self.dim_x])
 
         return new_state
 
@@ -260,23 +264,24 @@ class ObservationModel(tf.keras.Model):
             name='observation_fc3')
 
     def call(self, state, training, learn):
-        state = tf.reshape(state, [self.batch_size* self.num_ensemble, 1, self.dim_x])
+        num_ensemble = tf.shape(state)[1]
+        state = tf.reshape(state, [-1, 1, self.dim_x])
         if learn == False:
             H = tf.concat(
                 [tf.tile(np.array([[[1, 0, 0, 0, 0]]], dtype=np.float32),
-                         [self.batch_size* self.num_ensemble, 1, 1]),
+                         [tf.shape(state)[0], 1, 1]),
                  tf.tile(np.array([[[0, 1, 0, 0, 0]]], dtype=np.float32),
-                         [self.batch_size* self.num_ensemble, 1, 1])], axis=1)
+                         [tf.shape(state)[0], 1, 1])], axis=1)
             z_pred = tf.matmul(H, tf.transpose(state, perm=[0,2,1]))
             Z_pred = tf.transpose(z_pred, perm=[0,2,1])
-            z_pred = tf.reshape(z_pred, [self.batch_size, self.num_ensemble, self.dim_z])
+            z_pred = tf.reshape(z_pred, [-1, num_ensemble, self.dim_z])
         else:
             fc1 = self.observation_fc1(state)
             fcadd1 = self.observation_fc_add1(fc1)
             fc2 = self.observation_fc2(fcadd1)
             fcadd2 = self.observation_fc_add2(fc2)
             z_pred = self.observation_fc3(fcadd2)
-            z_pred = tf.reshape(z_pred, [self.batch_size, self.num_ensemble, self.dim_z])
+            z_pred = tf.reshape(z_pred, [-1, num_ensemble, self.dim_z])
 
         return z_pred
 
@@ -380,20 +385,17 @@ class BayesianSensorModel(tf.keras.Model):
             activation=None,
             name='bayes_sensor_fc4')
 
-    def call(self, state, training, learn):
+    def call(self, state, training, learn, num_ensemble=None):
+        if num_ensemble is None:
+            num_ensemble = self.num_ensemble
         if learn == True:
             inputs = state
             num_feature = inputs.shape[1]
             # expand to ensembles
-            for i in range (self.batch_size):
-                if i == 0:
-                    inputs_z = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-                else:
-                    tmp = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-                    inputs_z = tf.concat([inputs_z, tmp], 0)
+            inputs_z = tf.repeat(inputs, num_ensemble, axis=0)
 
             # make sure the ensemble shape matches
-            inputs_z = tf.reshape(inputs_z, [self.batch_size * self.num_ensemble, num_feature])
+            inputs_z = tf.reshape(inputs_z, [-1, num_feature])
 
             fc1 = self.bayes_sensor_fc1(inputs_z)
             fc2 = self.bayes_sensor_fc2(fc1)
@@ -401,10 +403,10 @@ class BayesianSensorModel(tf.keras.Model):
             observation = self.bayes_sensor_fc4(fcadd2)
             encoding = fcadd2
 
-            observation = tf.reshape(observation, [self.batch_size, self.num_ensemble, self.dim_z])
+            observation = tf.reshape(observation, [-1, num_ensemble, self.dim_z])
             observation_m = tf.reduce_mean(observation, axis = 1)
 
-            encoding = tf.reshape(encoding, [self.batch_size, self.num_ensemble, 32])
+            encoding = tf.reshape(encoding, [-1, num_ensemble, 32])
             encoding = tf.reduce_mean(encoding, axis = 1)
         else:
             observation = state
@@ -420,12 +422,16 @@ class BayesianImageSensorModel(tf.keras.Model):
     representation from the observation space.
     observation = [batch_size, dim_z]
     encoding = [batch_size, dim_fc2]
+    with shared_features=True the conv features stay at [batch_size, num_feature]
+    and the first bayesian layer is sampled per ensemble member from them
+    (see shared_fc1) instead of running it on num_ensemble tiled copies
     '''
-    def __init__(self, batch_size, num_ensemble, dim_z):
+    def __init__(self, batch_size, num_ensemble, dim_z, shared_features=False):
         super(BayesianImageSensorModel, self).__init__()
         self.batch_size = batch_size
         self.dim_z = dim_z
         self.num_ensemble = num_ensemble
+        self.shared_features = shared_features
 
     def build(self, input_shape):
         self.sensor_conv1 = tf.keras.layers.Conv2D(
@@ -485,41 +491,72 @@ class BayesianImageSensorModel(tf.keras.Model):
             activation=None,
             name='bayes_sensor_fc4')
 
-    def call(self, image, training, learn):
-        if learn == True:
-            conv1 = self.sensor_conv1(image)
-            conv1 = tf.nn.max_pool2d(conv1, 2, 2, padding='SAME')
-            conv2 = self.sensor_conv2(conv1)
-            conv2 = tf.nn.max_pool2d(conv2, 2, 2, padding='SAME')
-            conv3 = self.sensor_conv3(conv2)
-            conv3 = tf.nn.max_pool2d(conv3, 2, 2, padding='SAME')
-            conv4 = self.sensor_conv4(conv3)
-
-            inputs = self.flatten(conv4)
-            num_feature = inputs.shape[1]
-
+    def shared_fc1(self, inputs, num_ensemble):
+        '''
+        bayes_sensor_fc1 for all ensemble members from the shared features
+        inputs = [batch_size, num_feature] by local reparameterization:
+        with a gaussian kernel x W is gaussian with mean x W_mu + b and
+        variance x^2 sigma^2, one sample of it is drawn per ensemble member,
+        returns [batch_size*num_ensemble, units] like the tiled path
+        '''
+        layer = self.bayes_sensor_fc1
+        if not layer.built:
+            layer.build(inputs.shape)
+        kernel = layer.kernel_posterior.distribution
+        mean = tf.matmul(inputs, kernel.loc) + layer.bias_posterior_tensor_fn(layer.bias_posterior)
+        # the ReLU features can be all zero, the epsilon keeps the gradient of the sqrt finite
+        std = tf.sqrt(tf.matmul(tf.square(inputs), tf.square(kernel.scale)) + 1e-12)
+        eps = tf.random.normal([tf.shape(inputs)[0], num_ensemble, layer.units])
+        fc1 = tf.expand_dims(mean, 1) + tf.expand_dims(std, 1) * eps
+        return layer.activation(tf.reshape(fc1, [-1, layer.units]))
+
+    def encode(self, image):
+        '''
+        the conv part of the sensor model, it does not depend on the filter
+        state, so it can run ahead of the filter (see StreamRunner)
+        image = [batch_size, 224, 224, 3] -> features = [batch_size, num_feature]
+        '''
+        conv1 = self.sensor_conv1(image)
+        conv1 = tf.nn.max_pool2d(conv1, 2, 2, padding='SAME')
+        conv2 = self.sensor_conv2(conv1)
+        conv2 = tf.nn.max_pool2d(conv2, 2, 2, padding='SAME')
+        conv3 = self.sensor_conv3(conv2)
+        conv3 = tf.nn.max_pool2d(conv3, 2, 2, padding='SAME')
+        conv4 = self.sensor_conv4(conv3)
+
+        return self.flatten(conv4)
+
+    def head(self, inputs, num_ensemble=None):
+        '''
+        the bayesian layers of the sensor model on the features from encode,
+        returns observation = [batch_size, num_ensemble, dim_z], its mean and
+        the encoding = [batch_size, 32]
+        '''
+        if num_ensemble is None:
+            num_ensemble = self.num_ensemble
+        if self.shared_features:
+            fc1 = self.shared_fc1(inputs, num_ensemble)
+        else:
             # expand to ensembles
-            for i in range (self.batch_size):
-                if i == 0:
-                    inputs_z = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-                else:
-                    tmp = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-                    inputs_z = tf.concat([inputs_z, tmp], 0)
-
-            # make sure the ensemble shape matches
-            inputs_z = tf.reshape(inputs_z, [self.batch_size * self.num_ensemble, num_feature])
+            inputs_z = tf.repeat(inputs, num_ensemble, axis=0)
 
             fc1 = self.bayes_sensor_fc1(inputs_z)
-            fc2 = self.bayes_sensor_fc2(fc1)
-            fcadd2 = self.bayes_sensor_fc3(fc2)
-            observation = self.bayes_sensor_fc4(fcadd2)
-            encoding = fcadd2
+        fc2 = self.bayes_sensor_fc2(fc1)
+        fcadd2 = self.bayes_sensor_fc3(fc2)
+        observation = self.bayes_sensor_fc4(fcadd2)
+        encoding = fcadd2
 
-            observation = tf.reshape(observation, [self.batch_size, self.num_ensemble, self.dim_z])
-            observation_m = tf.reduce_mean(observation, axis = 1)
+        observation = tf.reshape(observation, [-1, num_ensemble, self.dim_z])
+        observation_m = tf.reduce_mean(observation, axis = 1)
 
-            encoding = tf.reshape(encoding, [self.batch_size, self.num_ensemble, 32])
-            encoding = tf.reduce_mean(encoding, axis = 1)
+        encoding = tf.reshape(encoding, [-1, num_ensemble, 32])
+        encoding = tf.reduce_mean(encoding, axis = 1)
+
+        return observation, observation_m, encoding
+
+    def call(self, image, training, learn, num_ensemble=None):
+        if learn == True:
+            observation, observation_m, encoding = self.head(self.encode(image), num_ensemble)
         else:
             observation = state
             encoding = state
@@ -639,6 +676,8 @@ class ProcessNoise(tf.keras.Model):
     if the state has 4 inputs
     state vector 4 -> fc 32 -> fc 64 -> 4
     the result is the diag of Q where Q is a 4x4 matrix
+    Q is sampled for num_ensemble members, the constructor's unless the
+    caller passes the ensemble size of its states
     '''
     def __init__(self, batch_size, num_ensemble, dim_x, q_diag):
         super(ProcessNoise, self).__init__()
@@ -689,7 +728,9 @@ class ProcessNoise(tf.keras.Model):
             regularizer = tf.keras.regularizers.l2(l=1e-3),
             initializer = tf.constant_initializer(init))
 
-    def call(self, state, training, learn):
+    def call(self, state, training, learn, num_ensemble=None):
+        if num_ensemble is None:
+            num_ensemble = self.num_ensemble
         if learn == True:
             fc1 = self.process_noise_fc1(state)
             fcadd1 = self.process_noise_fc_add1(fc1)
@@ -698,14 +739,10 @@ class ProcessNoise(tf.keras.Model):
             diag = tf.square(diag + self.learned_process_noise_bias)
         else:
             diag = tf.square(self.learned_process_noise_bias)
-            diag = tf.stack([diag] * (self.batch_size))
+            diag = tf.tile(diag[None, :], [tf.shape(state)[0], 1])
 
         diag = diag + self.fixed_process_noise_bias
-        mean = np.zeros((self.dim_x))
-        mean = tf.convert_to_tensor(mean, dtype=tf.float32)
-        mean = tf.stack([mean] * self.batch_size)
-        nd = tfp.distributions.MultivariateNormalDiag(loc=mean, scale_diag=diag)
-        Q = tf.reshape(nd.sample(self.num_ensemble), [self.batch_size, self.num_ensemble, self.dim_x])
+        Q = tf.random.normal([tf.shape(diag)[0], num_ensemble, self.dim_x]) * diag[:, None, :]
 
         return Q, diag
 
@@ -723,14 +760,19 @@ class ObservationNoise(tf.keras.Model):
     observation vector z is with size 2, the R has the size
     2 + (64 -> fc 2 -> 2) + fixed noise,
     the result is the diag of R where R is a 2x2 matrix
+    with dense=False R is kept structured, R = diag(diag) + U U^T, and the
+    model returns (U, diag) with a learned low-rank factor U = [batch_size,
+    dim_z, rank] (None if rank is 0) instead of (R, diag)
     '''
-    def __init__(self, batch_size, num_ensemble, dim_z, r_diag, jacobian):
+    def __init__(self, batch_size, num_ensemble, dim_z, r_diag, jacobian, dense=True, rank=0):
         super(ObservationNoise, self).__init__()
         self.batch_size = batch_size
         self.num_ensemble = num_ensemble
         self.jacobian = jacobian
         self.dim_z = dim_z
         self.r_diag = r_diag
+        self.dense = dense
+        self.rank = rank
 
     def build(self, input_shape):
         constant = np.ones(self.dim_z)* 1e-3
@@ -763,6 +805,15 @@ class ObservationNoise(tf.keras.Model):
             regularizer = tf.keras.regularizers.l2(l=1e-3),
             initializer = tf.constant_initializer(init))
 
+        if self.rank > 0:
+            self.observation_noise_factor = tf.keras.layers.Dense(
+                units=self.dim_z * self.rank,
+                activation=None,
+                kernel_initializer=tf.initializers.glorot_normal(),
+                kernel_regularizer=tf.keras.regularizers.l2(l=1e-3),
+                bias_regularizer=tf.keras.regularizers.l2(l=1e-3),
+                name='observation_noise_factor')
+
     def call(self, inputs, training, learn):
         if learn == True:
             diag = self.observation_noise_fc1(inputs)
@@ -770,12 +821,20 @@ class ObservationNoise(tf.keras.Model):
             diag = tf.square(diag + self.learned_observation_noise_bias)
         else:
             diag = tf.square(self.learned_observation_noise_bias)
-            diag = tf.stack([diag] * (self.batch_size))
+            diag = tf.tile(diag[None, :], [tf.shape(inputs)[0], 1])
 
         diag = diag + self.fixed_observation_noise_bias
+        diag = tf.reshape(diag, [-1, self.dim_z])
+
+        if self.dense == False:
+            U = None
+            if self.rank > 0 and learn == True:
+                U = self.observation_noise_factor(inputs)
+                U = tf.reshape(U, [-1, self.dim_z, self.rank])
+            return U, diag
+
         R = tf.linalg.diag(diag)
-        R = tf.reshape(R, [self.batch_size, self.dim_z, self.dim_z])
-        diag = tf.reshape(diag, [self.batch_size, self.dim_z])
+        R = tf.reshape(R, [-1, self.dim_z, self.dim_z])
 
         return R, diag
 
@@ -889,8 +948,8 @@ class utils:
         """
         # eliminate nans and infs (replace them with high values on the
         # diagonal and zeros else)
-        bs = covar.get_shape()[0]
-        dim = covar.get_shape()[-1]
+        bs = tf.shape(covar)[0]
+        dim = tf.shape(covar)[-1]
         covar = tf.where(tf.math.is_finite(covar), covar,
                          tf.eye(dim, batch_shape=[bs])*1e6)
 
@@ -899,7 +958,7 @@ class utils:
 
         # add a bit of noise to the diagonal of covar to prevent
         # nans in the gradient of the svd
-        noise = tf.random.uniform(covar.get_shape().as_list()[:-1], minval=0,
+        noise = tf.random.uniform(tf.shape(covar)[:-1], minval=0,
                                   maxval=0.001/self.scale**2)
         s, u, v = tf.linalg.svd(covar + tf.linalg.diag(noise))
         # test if the matrix is invertible
@@ -911,7 +970,7 @@ class utils:
         # the minimum eigenvalue is at least 1e-4/self.scale
         min_eig = s[..., -1:]
         eps = tf.tile(tf.maximum(1e-4/self.scale - min_eig, 0),
-                      [1, s.get_shape()[-1] ])
+                      [1, tf.shape(s)[-1] ])
         covar_invertible = tf.matmul(u, tf.matmul(tf.linalg.diag(s + eps), v,
                                                   adjoint_b=True))
 
@@ -925,6 +984,64 @@ class utils:
             (covar_valid + tf.linalg.matrix_transpose(covar_valid)) / 2.
 
         return covar_valid
+
+    def _cholesky(self, covar, jitter=1e-6):
+        """
+        Cholesky factor of a batch of covariance matrices that stays usable
+        in graph mode:
+          - the matrix is made symmetric, nans and infs are replaced like in
+            _make_valid and a small jitter relative to the mean diagonal is
+            added, then it is factored directly. the matrices of the update
+            are I + PSD or (N-1)I + PSD, so this is the path that runs
+          - only if the batch had non-finite entries the tf.cond branch of
+            _clip_eigenvalues computes a repair. the repair is not
+            differentiated, the gradient is passed straight through to the
+            matrix, so no gradient flows through the cond and the train step
+            also compiles with XLA
+        Parameters
+        ----------
+        covar : tensor
+            a batch of covariance matrices [batch_size, dim, dim]
+        jitter : float, optional
+            diagonal offset relative to the mean of the diagonal
+        Returns
+        -------
+        chol : tensor
+            the lower triangular cholesky factors of the (repaired) matrices
+        """
+        dim = tf.shape(covar)[-1]
+        eye = tf.eye(dim, dtype=covar.dtype)
+        covar = (covar + tf.linalg.matrix_transpose(covar)) / 2.
+        finite = tf.math.is_finite(covar)
+        covar = tf.where(finite, covar, tf.zeros_like(covar) + eye*1e6)
+        scale = tf.reduce_mean(tf.abs(tf.linalg.diag_part(covar)), axis=-1)
+        covar = covar + eye * (jitter * scale + 1e-12)[:, None, None]
+        covar_fixed = tf.stop_gradient(covar)
+        repair = tf.cond(tf.reduce_all(finite),
+                         lambda: tf.zeros_like(covar_fixed),
+                         lambda: self._clip_eigenvalues(covar_fixed) - covar_fixed)
+        chol = tf.linalg.cholesky(covar + repair)
+        return chol
+
+    def _clip_eigenvalues(self, covar):
+        """
+        clips the eigenvalues of a batch of symmetric matrices to at least
+        1e-4/self.scale (the minimum _make_valid enforces). unlike _make_valid
+        this works for matrices whose size is only known at runtime
+        Parameters
+        ----------
+        covar : tensor
+            a batch of symmetric matrices [batch_size, dim, dim]
+        Returns
+        -------
+        covar_valid : tensor
+            the repaired matrices
+        """
+        s, u = tf.linalg.eigh(covar)
+        s_valid = tf.maximum(s, 1e-4/self.scale)
+        covar_valid = tf.matmul(u * s_valid[..., None, :], u, adjoint_b=True)
+        covar_valid = (covar_valid + tf.linalg.matrix_transpose(covar_valid)) / 2.
+        return covar_valid
     ###########################################################################
 
 class bayesiantransition(tf.keras.Model):
@@ -949,9 +1066,11 @@ class bayesiantransition(tf.keras.Model):
 
         state_old, m_state = input_states
 
-        state_old = tf.reshape(state_old, [self.batch_size, self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(state_old)[1]
+
+        state_old = tf.reshape(state_old, [-1, num_ensemble, self.dim_x])
 
-        m_state = tf.reshape(m_state, [self.batch_size, self.dim_x])
+        m_state = tf.reshape(m_state, [-1, self.dim_x])
 
         # get prediction and noise of next state
         training = True
@@ -960,9 +1079,9 @@ class bayesiantransition(tf.keras.Model):
         # the ensemble state mean
         m_state = tf.reduce_mean(state_pred, axis = 1)
 
-        ensemble = tf.reshape(state_pred, [self.batch_size, self.num_ensemble, self.dim_x])
+        ensemble = tf.reshape(state_pred, [-1, num_ensemble, self.dim_x])
 
-        m_state = tf.reshape(m_state, [self.batch_size, 1, self.dim_x])
+        m_state = tf.reshape(m_state, [-1, 1, self.dim_x])
 
         # tuple structure of updated state
         output = (ensemble, m_state)
@@ -973,7 +1092,8 @@ class bayesiantransition(tf.keras.Model):
 
 # Xiao's version
 class enKFMLP(tf.keras.Model):
-    def __init__(self, batch_size, num_ensemble, dropout_rate,**kwargs):
+    def __init__(self, batch_size, num_ensemble, dropout_rate, update_mode='auto', noise_rank=0, shared_features=False,
+                 filter_type='enkf', **kwargs):
         super(enKFMLP, self).__init__()
 
         # initialization
@@ -996,22 +1116,117 @@ class enKFMLP(tf.keras.Model):
         self.observation_model = ObservationModel(self.batch_size, self.num_ensemble, self.dim_x, self.dim_z, self.jacobian)
 
         # learned observation noise
-        self.observation_noise_model = ObservationNoise(self.batch_size, self.num_ensemble, self.dim_z, self.r_diag, self.jacobian)
+        # R is kept as diagonal (plus low-rank) factors, see innovation_solve
+        self.observation_noise_model = ObservationNoise(self.batch_size, self.num_ensemble, self.dim_z, self.r_diag, self.jacobian,
+                                                        dense=False, rank=noise_rank)
 
         # learned sensor model
-        self.sensor_model = BayesianImageSensorModel(self.batch_size, self.num_ensemble, self.dim_z)
+        self.sensor_model = BayesianImageSensorModel(self.batch_size, self.num_ensemble, self.dim_z,
+                                                     shared_features=shared_features)
 
         self.utils_ = utils()
 
-    def call(self, inputs, states):
+        # 'dense' solves with the dim_z x dim_z innovation matrix, 'ensemble'
+        # works in the num_ensemble dimensional ensemble subspace, 'auto'
+        # picks whichever of the two is smaller for the constructor's num_ensemble
+        if update_mode == 'auto':
+            update_mode = 'ensemble' if self.dim_z > self.num_ensemble + noise_rank else 'dense'
+        if update_mode not in ['dense', 'ensemble']:
+            raise ValueError('unknown update_mode: ' + str(update_mode))
+        self.update_mode = update_mode
+
+        # 'enkf' updates every member with the sensor ensemble as perturbed
+        # observations, 'etkf' transforms the ensemble, see transform_update
+        if filter_type not in ['enkf', 'etkf']:
+            raise ValueError('unknown filter_type: ' + str(filter_type))
+        self.filter_type = filter_type
+
+    def innovation_solve(self, H_A, diag_R, y_bar, U_R=None):
+        '''
+        returns innovation^-1 y_bar with innovation = H_A^T H_A / (N-1) + R,
+        H_A = [batch_size, num_ensemble, dim_z], y_bar = [batch_size, dim_z, num_ensemble]
+        R = diag(diag_R) + U_R U_R^T is never formed, everything is whitened
+        with R_diag^-1/2 first, the low-rank factor is appended to the
+        whitened ensemble Y, so the whitened innovation is Y Y^T / (N-1) + I.
+        in ensemble mode the Woodbury identity replaces the dim_z x dim_z
+        solve by a (num_ensemble + rank) dimensional one:
+        (Y Y^T / (N-1) + I)^-1 = I - Y ((N-1) I + Y^T Y)^-1 Y^T
+        '''
+        N = tf.cast(tf.shape(H_A)[1], tf.float32)
+        R_isqrt = tf.expand_dims(tf.math.rsqrt(diag_R), axis = -1)
+        Y = R_isqrt * tf.transpose(H_A, perm=[0,2,1])
+        if U_R is not None:
+            Y = tf.concat([Y, tf.sqrt(N -1) * R_isqrt * U_R], axis = -1)
+        y_w = R_isqrt * y_bar
+        if self.update_mode == 'dense':
+            innovation = tf.matmul(Y, Y, transpose_b=True) / (N -1) + tf.eye(self.dim_z)
+            innovation_chol = self.utils_._cholesky(innovation)
+            innovation_y = tf.linalg.cholesky_solve(innovation_chol, y_w)
+        else:
+            core = tf.matmul(Y, Y, transpose_a=True) + (N -1) * tf.eye(tf.shape(Y)[-1])
+            core_chol = self.utils_._cholesky(core)
+            core_y = tf.linalg.cholesky_solve(core_chol, tf.matmul(Y, y_w, transpose_a=True))
+            innovation_y = y_w - tf.matmul(Y, core_y)
+        return R_isqrt * innovation_y
+
+    def transform_update(self, state_pred, H_X, z, U_R, diag_R):
+        '''
+        ensemble transform (square root) update without perturbed observations,
+        with the whitened observation anomalies Y = R^-1/2 H_A^T the N x N
+        matrix Pa = ((N-1) I + Y^T Y)^-1 gives the mean weights
+        w = Pa Y^T R^-1/2 (z - mean(H_X)) and the anomaly transform
+        W = ((N-1) Pa)^1/2, the new ensemble is x_a = mean(x) + X (w + W).
+        the symmetric square root is taken with an eigh in float64, so the
+        gradient stays finite when eigenvalues repeat (dim_z < num_ensemble)
+        '''
+        N = tf.shape(state_pred)[1]
+        n = tf.cast(N -1, tf.float32)
+        m_H = tf.reduce_mean(H_X, axis = 1)
+        H_A = H_X - tf.expand_dims(m_H, axis = 1)
+        R_isqrt = tf.expand_dims(tf.math.rsqrt(diag_R), axis = -1)
+        Y = R_isqrt * tf.transpose(H_A, perm=[0,2,1])
+        d = R_isqrt * tf.expand_dims(tf.reshape(z, [-1, self.dim_z]) - m_H, axis = -1)
+        C = tf.matmul(Y, Y, transpose_a=True)
+        g = tf.matmul(Y, d, transpose_a=True)
+        if U_R is not None:
+            # R^-1 = R_diag^-1/2 (I + U U^T)^-1 R_diag^-1/2 with the whitened
+            # factor U, the inverse is taken through the rank x rank core
+            U = R_isqrt * U_R
+            core = tf.matmul(U, U, transpose_a=True) + tf.eye(tf.shape(U)[-1])
+            core_chol = self.utils_._cholesky(core)
+            UY = tf.matmul(U, Y, transpose_a=True)
+            C = C - tf.matmul(UY, tf.linalg.cholesky_solve(core_chol, UY), transpose_a=True)
+            g = g - tf.matmul(UY, tf.linalg.cholesky_solve(core_chol, tf.matmul(U, d, transpose_a=True)),
+                              transpose_a=True)
+        M = n * tf.eye(N) + (C + tf.transpose(C, perm=[0,2,1])) / 2.
+        s, V = tf.linalg.eigh(tf.cast(M, tf.float64))
+        s = tf.expand_dims(s, axis = 1)
+        Pa = tf.matmul(V / s, V, transpose_b=True)
+        W = tf.matmul(V * tf.sqrt(tf.cast(n, tf.float64) / s), V, transpose_b=True)
+        Pa = tf.cast(Pa, tf.float32)
+        W = tf.cast(W, tf.float32)
+        w = tf.matmul(Pa, g)
+
+        # A matrix, the columns of X (w + W) are the rows of (w + W)^T A
+        m_A = tf.reduce_mean(state_pred, axis = 1, keepdims = True)
+        A = state_pred - m_A
+        return m_A + tf.matmul(w + W, A, transpose_a=True)
+
+    def call(self, inputs, states, encoded=False, observed=None):
         # decompose inputs and states
+        # with encoded=True inputs are the features from sensor_model.encode
+        # observed = [batch_size] (bool) is False for the elements without an
+        # observation at this step, those keep the prediction as the new state
         raw_sensor = inputs
 
         state_old, m_state = states
 
-        state_old = tf.reshape(state_old, [self.batch_size, self.num_ensemble, self.dim_x])
+        # the ensemble size is taken from the states, not from the constructor
+        num_ensemble = tf.shape(state_old)[1]
 
-        m_state = tf.reshape(m_state, [self.batch_size, self.dim_x])
+        state_old = tf.reshape(state_old, [-1, num_ensemble, self.dim_x])
+
+        m_state = tf.reshape(m_state, [-1, self.dim_x])
 
 
         # get prediction and noise of next state
@@ -1026,71 +1241,223 @@ class enKFMLP(tf.keras.Model):
 
         # get the emsemble mean of the observations
         m = tf.reduce_mean(H_X, axis = 1)
-        for i in range (self.batch_size):
-            if i == 0:
-                mean = tf.reshape(tf.stack([m[i]] * self.num_ensemble), [self.num_ensemble, self.dim_z])
-            else:
-                tmp = tf.reshape(tf.stack([m[i]] * self.num_ensemble), [self.num_ensemble, self.dim_z])
-                mean = tf.concat([mean, tmp], 0)
+        H_A = H_X - tf.expand_dims(m, axis = 1)
 
-        mean = tf.reshape(mean, [self.batch_size, self.num_ensemble, self.dim_z])
-        H_A = H_X - mean
-
-        final_H_A = tf.transpose(H_A, perm=[0,2,1])
         final_H_X = tf.transpose(H_X, perm=[0,2,1])
 
         # get sensor reading
-        ensemble_z, z, encoding = self.sensor_model(raw_sensor, training, learn = True)
+        if encoded:
+            ensemble_z, z, encoding = self.sensor_model.head(raw_sensor, num_ensemble)
+        else:
+            ensemble_z, z, encoding = self.sensor_model(raw_sensor, training, learn = True,
+                                                        num_ensemble = num_ensemble)
 
         # get observation noise
-        R, diag_R = self.observation_noise_model(encoding, training, True)
-
-
-        # the measurement y
-        y = ensemble_z
-        y = tf.transpose(y, perm=[0,2,1])
-
-        # calculated innovation matrix s
-        innovation = (1/(self.num_ensemble -1)) * tf.matmul(final_H_A,  H_A) + R
-
-        # A matrix
-        m_A = tf.reduce_mean(state_pred, axis = 1)
-        for i in range (self.batch_size):
-            if i == 0:
-                mean_A = tf.reshape(tf.stack([m_A[i]] * self.num_ensemble), [1, self.num_ensemble, self.dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([m_A[i]] * self.num_ensemble), [1, self.num_ensemble, self.dim_x])
-                mean_A = tf.concat([mean_A, tmp], 0)
-        A = state_pred - mean_A
-        A = tf.transpose(A, perm = [0,2,1])
+        U_R, diag_R = self.observation_noise_model(encoding, training, True)
 
-        try:
-            innovation_inv = tf.linalg.inv(innovation)
-        except:
-            innovation = self.utils_._make_valid(innovation)
-            innovation_inv = tf.linalg.inv(innovation)
-
-        # calculating Kalman gain
-        K = (1/(self.num_ensemble -1)) * tf.matmul(tf.matmul(A, H_A), innovation_inv)
 
-        # update state of each ensemble
-        y_bar = y - final_H_X
-        state_new = state_pred +  tf.transpose(tf.matmul(K, y_bar), perm=[0,2,1])
+        if self.filter_type == 'etkf':
+            state_new = self.transform_update(state_pred, H_X, z, U_R, diag_R)
+        else:
+            # the measurement y
+            y = ensemble_z
+            y = tf.transpose(y, perm=[0,2,1])
+
+            # A matrix
+            m_A = tf.reduce_mean(state_pred, axis = 1, keepdims = True)
+            A = state_pred - m_A
+            A = tf.transpose(A, perm = [0,2,1])
+
+            # update state of each ensemble, the Kalman gain
+            # K = A H_A innovation^-1 / (N-1) is applied to y_bar through a
+            # solve instead of inverting the innovation matrix
+            y_bar = y - final_H_X
+            innovation_y = self.innovation_solve(H_A, diag_R, y_bar, U_R)
+            K_y = tf.matmul(A, tf.matmul(H_A, innovation_y)) / tf.cast(num_ensemble -1, tf.float32)
+            state_new = state_pred +  tf.transpose(K_y, perm=[0,2,1])
+        if observed is not None:
+            state_new = tf.where(tf.reshape(observed, [-1, 1, 1]), state_new, state_pred)
 
         # the ensemble state mean
         m_state_new = tf.reduce_mean(state_new, axis = 1)
 
-        m_state_new = tf.reshape(m_state_new, [self.batch_size, 1, self.dim_x])
+        m_state_new = tf.reshape(m_state_new, [-1, 1, self.dim_x])
 
         m_state_pred = tf.reduce_mean(state_pred, axis = 1)
 
-        m_state_pred = tf.reshape(m_state_pred, [self.batch_size, 1, self.dim_x])
+        m_state_pred = tf.reshape(m_state_pred, [-1, 1, self.dim_x])
 
-        z = tf.reshape(z, [self.batch_size, 1, self.dim_z])
+        z = tf.reshape(z, [-1, 1, self.dim_z])
 
         # tuple structure of updated state
         output = (state_new, m_state_new, m_state_pred, z)
 
         return output
 
+    def rollout(self, observations, init_states, mask=None):
+        '''
+        runs the filter over a whole sequence inside one tf.scan,
+        observations = [T, batch_size, ...] (a tuple of them for several sensors),
+        init_states = (ensemble, m_state), returns the outputs of every step
+        stacked along a leading time axis.
+        mask = [T, batch_size] (bool) marks the valid steps when trajectories of
+        different lengths are packed into one batch, on the padded steps the
+        states are carried over unchanged
+        '''
+        ensemble, m_state = init_states
+        m_state = tf.reshape(m_state, [-1, 1, self.dim_x])
+        initializer = (ensemble, m_state, m_state, tf.zeros([tf.shape(ensemble)[0], 1, self.dim_z]))
+
+        if mask is None:
+            mask = tf.ones([tf.shape(tf.nest.flatten(observations)[0])[0], tf.shape(ensemble)[0]], tf.bool)
+
+        def step(output, inputs):
+            raw_sensor, valid = inputs
+            out = self.call(raw_sensor, (output[0], output[1]))
+            valid = tf.reshape(valid, [-1, 1, 1])
+            return (tf.where(valid, out[0], output[0]),
+                    tf.where(valid, out[1], output[1])) + tuple(out[2:])
+
+        return tf.scan(step, (observations, mask), initializer=initializer)
+
+
+class FilterStep:
+    '''
+    compiled train and test steps of an enKFMLP model, both are wrapped in a
+    tf.function with a fixed input signature (raw_sensor, (ensemble, m_state)),
+    so they are traced once and not retraced between steps.
+    sensor_spec is the tf.TensorSpec of raw_sensor (or a tuple of specs),
+    the batch and ensemble dimensions are left open, so one FilterStep serves
+    any batch size and the ensemble size can be picked per call
+    train_step(raw_sensor, states, gt_now) runs the forward pass, all losses
+    and the gradient updates, test_step(raw_sensor, states) runs one filter step,
+    rollout(observations, states) runs a whole sequence [T, ...] in one graph,
+    masked_rollout(observations, states, mask) runs trajectories of unequal
+    lengths packed into the batch (see DataLoader.pad_trajectories),
+    observed_step(raw_sensor, states, observed) is test_step with a [batch_size]
+    observation mask, masked elements only run the prediction,
+    encode(raw_sensor) and encoded_step(features, states) split test_step into
+    the conv part of the sensor model and the rest of the filter step
+    with jit_compile=True both steps are compiled with XLA, a step that cannot
+    be compiled raises an error instead of falling back to the plain graph.
+    encode and encoded_step call parts of the model directly, so an unbuilt
+    model is built first with one call on zeros
+    '''
+    def __init__(self, model, optimizer, sensor_spec, jit_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.get_loss = getloss()
+        if not model.built:
+            raw_sensor = tf.nest.map_structure(
+                lambda spec: tf.zeros([1 if d is None else d for d in spec.shape.as_list()], spec.dtype),
+                sensor_spec)
+            batch_size = tf.nest.flatten(raw_sensor)[0].shape[0]
+            model(raw_sensor, (tf.zeros([batch_size, model.num_ensemble, model.dim_x]),
+                               tf.zeros([batch_size, 1, model.dim_x])))
+        state_spec = (tf.TensorSpec([None, None, model.dim_x], tf.float32),
+                      tf.TensorSpec([None, 1, model.dim_x], tf.float32))
+        gt_spec = tf.TensorSpec([None, 1, model.dim_x], tf.float32)
+        self.train_step = tf.function(self.train, input_signature=[sensor_spec, state_spec, gt_spec],
+                                      experimental_compile=jit_compile)
+        self.test_step = tf.function(self.test, input_signature=[sensor_spec, state_spec],
+                                     experimental_compile=jit_compile)
+        sequence_spec = tf.nest.map_structure(
+            lambda spec: tf.TensorSpec([None] + spec.shape.as_list(), spec.dtype), sensor_spec)
+        self.rollout = tf.function(model.rollout, input_signature=[sequence_spec, state_spec],
+                                   experimental_compile=jit_compile)
+        mask_spec = tf.TensorSpec([None, None], tf.bool)
+        self.observed_step = tf.function(self.test_observed,
+                                         input_signature=[sensor_spec, state_spec, tf.TensorSpec([None], tf.bool)],
+                                         experimental_compile=jit_compile)
+        self.masked_rollout = tf.function(model.rollout, input_signature=[sequence_spec, state_spec, mask_spec],
+                                          experimental_compile=jit_compile)
+        self.encode = tf.function(model.sensor_model.encode, input_signature=[sensor_spec],
+                                  experimental_compile=jit_compile)
+        feature_spec = tf.TensorSpec([None, None], tf.float32)
+        self.encoded_step = tf.function(self.test_encoded, input_signature=[feature_spec, state_spec],
+                                        experimental_compile=jit_compile)
+
+    def apply(self, tape, loss, model):
+        grads = tape.gradient(loss, model.trainable_weights)
+        self.optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+    def train(self, raw_sensor, states, gt_now):
+        with tf.GradientTape(persistent=True) as tape:
+            out = self.model(raw_sensor, states)
+            state_h = out[1]
+            state_p = out[2]
+            y = out[3]
+            loss_1 = self.get_loss._mse(gt_now - state_p)
+            loss_2 = self.get_loss._mse(gt_now - y)
+            loss = self.get_loss._mse(gt_now - state_h)
+        self.apply(tape, loss, self.model)
+        self.apply(tape, loss_1, self.model.bayesian_process_model)
+        self.apply(tape, loss_2, self.model.sensor_model)
+        del tape
+        return (loss, loss_1, loss_2), out
+
+    def test(self, raw_sensor, states):
+        return self.model(raw_sensor, states)
+
+    def test_observed(self, raw_sensor, states, observed):
+        return self.model(raw_sensor, states, observed=observed)
+
+    def test_encoded(self, features, states):
+        return self.model(features, states, encoded=True)
+
+
+class StreamRunner:
+    '''
+    streaming inference with the sensor encoding pipelined ahead of the filter,
+    the conv part of the sensor model does not depend on the filter state, so
+    a background thread runs filter_step.encode on the incoming frames and
+    keeps at most queue_size encodings ready, while the filter update of
+    frame t runs the frames after it are being encoded.
+    run(frames, states) takes any iterable of raw_sensor batches and yields
+    the output of the filter step of every frame. if the consumer stops early
+    the encoder thread is stopped and joined as well
+    '''
+    def __init__(self, filter_step, queue_size=4):
+        self.filter_step = filter_step
+        self.queue_size = queue_size
+
+    def run(self, frames, states):
+        buffer = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up once the consumer is gone instead of blocking on a full queue
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def encode():
+            try:
+                for raw_sensor in frames:
+                    if not put(self.filter_step.encode(raw_sensor)):
+                        return
+            except Exception as e:
+                put(e)
+            put(None)
+
+        encoder = threading.Thread(target=encode, daemon=True)
+        encoder.start()
+        try:
+            while True:
+                features = buffer.get()
+                if features is None:
+                    break
+                if isinstance(features, Exception):
+                    raise features
+                out = self.filter_step.encoded_step(features, states)
+                states = (out[0], out[1])
+                yield out
+        finally:
+            stop.set()
+            encoder.join()
+
 
@@ -12,9 +12,10 @@ import pdb
 import tensorflow_probability as tfp
 import csv
 import cv2
+import itertools
 
 import diff_enKF
-from dataloader import DataLoader
+from dataloader import DataLoader, EpochSampler
 
 
 '''
@@ -38,41 +39,37 @@ def run_filter(mode):
 
         optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
 
+        # compiled forward pass, losses and updates
+        filter_step = diff_enKF.FilterStep(model, optimizer, tf.TensorSpec([None, 224, 224, 3], tf.float32))
+
+        csv_path = './dataset/dataset_UR5.csv'
+        DataLoader.set_decode_workers(os.cpu_count())
+        N = DataLoader.load_cache(csv_path)['img_path'].shape[0]
+        sampler = EpochSampler(N, batch_size, seed=0)
+        dataset = iter(DataLoader.train_dataset(csv_path, batch_size, 'All', image_store=True, sampler=sampler))
+
         epoch = 200
         for k in range (epoch):
             print('end-to-end wholemodel')
             print("========================================= working on epoch %d =========================================: " % (k))
-            steps = math.floor(200*1000 /batch_size)
+            steps = sampler.steps_per_epoch
             for step in range(steps):
-                csv_path = './dataset/dataset_UR5.csv'
-                gt_pre, gt_now, raw_sensor = DataLoader.load_train_data_All(csv_path, batch_size)
-                with tf.GradientTape(persistent=True) as tape:
-                    start = time.time()
-                    states = DataLoader.format_state(gt_pre, batch_size, num_ensemble, dim_x)
-                    out = model(raw_sensor,states)
+                gt_pre, gt_now, raw_sensor = next(dataset)
+                start = time.time()
+                states = DataLoader.format_state(gt_pre, batch_size, num_ensemble, dim_x)
+                (loss, loss_1, loss_2), out = filter_step.train_step(raw_sensor, states, gt_now)
+                end = time.time()
+                if step %500 ==0:
                     state_h = out[1]
                     state_p = out[2]
                     y = out[3]
-                    loss_1 = get_loss._mse(gt_now - state_p)
-                    loss_2 = get_loss._mse(gt_now - y)
-                    loss = get_loss._mse(gt_now - state_h)
-                    end = time.time()
-                    if step %500 ==0:
-                        print("Training loss at step %d: %.4f (took %.3f seconds) " %
-                              (step, float(loss), float(end-start)))
-                        print(state_p[0])
-                        print(y[0])
-                        print(state_h[0])
-                        print(gt_now[0])
-                        print('---')
-                grads = tape.gradient(loss, model.trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.trainable_weights))
-
-                grads = tape.gradient(loss_1, model.layers[0].trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.layers[0].trainable_weights))
-
-                grads = tape.gradient(loss_2, model.layers[3].trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.layers[3].trainable_weights))
+                    print("Training loss at step %d: %.4f (took %.3f seconds) " %
+                          (step, float(loss), float(end-start)))
+                    print(state_p[0])
+                    print(y[0])
+                    print(state_h[0])
+                    print(gt_now[0])
+                    print('---')
 
             if (k+1) % epoch == 0:
                 model.save_weights('./models/bayes_enkf_'+version+'_'+name[index]+str(epoch).zfill(3)+'.h5')
@@ -84,30 +81,36 @@ def run_filter(mode):
                 # define batch_size
                 test_batch_size = 1
 
-                test_num_ensemble = 32
-
-                test_dropout_rate = 0.1
-
-                # load the model
-                model_test = diff_enKF.enKFMLPAll(test_batch_size, test_num_ensemble, test_dropout_rate)
+                test_num_ensemble = num_ensemble
 
+                # the model is evaluated as it is, no rebuild or weight reload
                 csv_path = './dataset/dataset_UR5_test.csv'
 
-                test_gt_pre, test_gt_now, test_raw_sensor = DataLoader.load_test_data_All(csv_path, test_batch_size)
+                test_window = 64
+                test_stream = DataLoader.stream_test_data_All(csv_path, test_batch_size, image_store=True, window=test_window)
+                test_first = next(test_stream)
 
                 # load init state
-                inputs = test_raw_sensor[0]
-                init_states = DataLoader.format_init_state(test_gt_pre[0], test_batch_size, test_num_ensemble,dim_x)
+                init_states = DataLoader.format_init_state(test_first[0][0], test_batch_size, test_num_ensemble,dim_x)
 
-                dummy = model_test(inputs, init_states)
-                model_test.load_weights('./models/bayes_enkf_'+version+'_'+name[index]+str(k).zfill(3)+'.h5')
-                for layer in model_test.layers:
-                    layer.trainable = False
-                model_test.summary()
+                rollout = filter_step.rollout
 
                 '''
                 run a test demo and save the state of the test demo
                 '''
+                # the filter runs over test_window steps per call, the states are
+                # carried over between the windows and copied back once at the end
+                outs = []
+                gts = []
+                states = init_states
+                for test_gt_pre, test_gt_now, test_raw_sensor in itertools.chain([test_first], test_stream):
+                    out = rollout(test_raw_sensor, states)
+                    states = (out[0][-1], out[1][-1])
+                    outs.append(out)
+                    gts.append(test_gt_now)
+                out = [np.concatenate([np.array(o[n]) for o in outs]) for n in range (4)]
+                test_gt_now = np.concatenate([np.array(gt) for gt in gts])
+
                 data = {}
                 data_save = []
                 emsemble_save = []
@@ -116,19 +119,15 @@ def run_filter(mode):
                 observation_save = []
 
                 for t in range (test_gt_now.shape[0]):
-                    if t == 0:
-                        states = init_states
-                    out = model_test(test_raw_sensor[t], states)
                     if t%10 == 0:
                         print('---')
-                        print(out[1])
+                        print(out[1][t])
                         print(test_gt_now[t])
-                    states = (out[0], out[1])
-                    state_out = np.array(out[1])
-                    gt_out = np.array(test_gt_now[t])
-                    ensemble = np.array(tf.reshape(out[0], [test_num_ensemble, dim_x]))
-                    transition_out = np.array(out[2])
-                    observation_out = np.array(out[3])
+                    state_out = out[1][t]
+                    gt_out = test_gt_now[t]
+                    ensemble = np.reshape(out[0][t], [test_num_ensemble, dim_x])
+                    transition_out = out[2][t]
+                    observation_out = out[3][t]
                     data_save.append(state_out)
                     emsemble_save.append(ensemble)
                     gt_save.append(gt_out)
@@ -157,21 +156,37 @@ def run_filter(mode):
 
         csv_path = './dataset/dataset_UR5_test.csv'
 
-        test_gt_pre, test_gt_now, test_raw_sensor = DataLoader.load_test_data_All(csv_path, test_batch_size)
+        test_window = 64
+        test_stream = DataLoader.stream_test_data_All(csv_path, test_batch_size, image_store=True, window=test_window)
+        test_first = next(test_stream)
 
         # load init state
-        inputs = test_raw_sensor[0]
-        init_states = DataLoader.format_init_state(test_gt_pre[0], test_batch_size, test_num_ensemble,dim_x)
+        inputs = test_first[2][0]
+        init_states = DataLoader.format_init_state(test_first[0][0], test_batch_size, test_num_ensemble,dim_x)
 
         dummy = model_test(inputs, init_states)
         model_test.load_weights('./models/bayes_enkf_'+version+'_'+name[index]+str(k).zfill(3)+'.h5')
         for layer in model_test.layers:
             layer.trainable = False
         model_test.summary()
+        rollout = diff_enKF.FilterStep(model_test, None, tf.TensorSpec([None, 224, 224, 3], tf.float32)).rollout
 
         '''
         run a test demo and save the state of the test demo
         '''
+        # the filter runs over test_window steps per call, the states are
+        # carried over between the windows and copied back once at the end
+        outs = []
+        gts = []
+        states = init_states
+        for test_gt_pre, test_gt_now, test_raw_sensor in itertools.chain([test_first], test_stream):
+            out = rollout(test_raw_sensor, states)
+            states = (out[0][-1], out[1][-1])
+            outs.append(out)
+            gts.append(test_gt_now)
+        out = [np.concatenate([np.array(o[n]) for o in outs]) for n in range (4)]
+        test_gt_now = np.concatenate([np.array(gt) for gt in gts])
+
         data = {}
         data_save = []
         emsemble_save = []
@@ -180,21 +195,17 @@ def run_filter(mode):
         observation_save = []
 
         for t in range (test_gt_now.shape[0]):
-            if t == 0:
-                states = init_states
-            out = model_test(test_raw_sensor[t], states)
             if t%10 == 0:
                 print('---')
-                print(out[1]) # final state
-                print(out[2]) # transition 
-                print(out[3]) # sensor model
+                print(out[1][t]) # final state
+                print(out[2][t]) # transition 
+                print(out[3][t]) # sensor model
                 print(test_gt_now[t])
-            states = (out[0], out[1])
-            state_out = np.array(out[1])
-            gt_out = np.array(test_gt_now[t])
-            ensemble = np.array(tf.reshape(out[0], [test_num_ensemble, dim_x]))
-            transition_out = np.array(out[2])
-            observation_out = np.array(out[3])
+            state_out = out[1][t]
+            gt_out = test_gt_now[t]
+            ensemble = np.reshape(out[0][t], [test_num_ensemble, dim_x])
+            transition_out = out[2][t]
+            observation_out = out[3][t]
             data_save.append(state_out)
             emsemble_save.append(ensemble)
             gt_save.append(gt_out)
@@ -13,46 +13,289 @@ import tensorflow_probability as tfp
 import csv
 import cv2
 import re
+import queue
+import threading
+import multiprocessing
+import atexit
+import functools
+import shutil
+
+# state of a decode worker process, see DecodePool
+_worker = {}
+
+def _init_decode_worker(buffer, func, shape, dtype, num_slots):
+    cv2.setNumThreads(0)
+    _worker['slots'] = np.frombuffer(buffer, dtype=dtype).reshape((num_slots,) + tuple(shape))
+    _worker['func'] = func
+
+def _decode(slot, item):
+    _worker['slots'][slot] = _worker['func'](item)
+
+def _preprocess_pair(dataset_path, pair):
+    img_2 = cv2.imread(dataset_path+pair[1])
+    img_1 = cv2.imread(dataset_path+pair[0])
+    img_2 = cv2.resize(img_2, (150, 50), interpolation=cv2.INTER_LINEAR)
+    img_1 = cv2.resize(img_1, (150, 50), interpolation=cv2.INTER_LINEAR)
+    img_2_ = img_2.astype(np.float32)/255.
+    img_1_ = img_1.astype(np.float32)/255.
+    ###########
+    diff = img_2_ - img_1_
+    diff = diff*0.5 + 0.5
+    # diff = (diff * 255).astype(np.uint8)
+    ###########
+    img = np.concatenate((img_2_, diff), axis=-1)
+    return img
+
+class DecodePool:
+    '''
+    decodes/preprocesses images in num_workers processes with func, the workers
+    write their results into a shared memory buffer instead of sending pickled
+    arrays back. the buffer holds num_blocks blocks of block_size images,
+    every call of map works on its own block, so the pool can be shared by
+    several loader threads. once closed, map decodes in the calling thread
+    '''
+    def __init__(self, func, shape, dtype, num_workers, block_size=64, num_blocks=4):
+        self.func = func
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        num_slots = block_size * num_blocks
+        buffer = multiprocessing.RawArray('b', num_slots * int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.slots = np.frombuffer(buffer, dtype=self.dtype).reshape((num_slots,) + self.shape)
+        self.free_blocks = queue.Queue()
+        for block in range (num_blocks):
+            self.free_blocks.put(block)
+        self.pool = multiprocessing.Pool(num_workers, initializer=_init_decode_worker,
+                                         initargs=(buffer, func, self.shape, self.dtype.str, num_slots))
+        self.closed = False
+        # close before multiprocessing tears the workers down at exit, otherwise
+        # loader threads that are still waiting on the pool never return
+        atexit.register(self.close)
+
+    def map(self, items):
+        out = np.empty((len(items),) + self.shape, dtype=self.dtype)
+        if self.closed:
+            for i, item in enumerate(items):
+                out[i] = self.func(item)
+            return out
+        block = self.free_blocks.get()
+        try:
+            offset = block * self.block_size
+            for start in range (0, len(items), self.block_size):
+                chunk = items[start:start + self.block_size]
+                result = self.pool.starmap_async(_decode, [(offset + i, item) for i, item in enumerate(chunk)])
+                while not result.ready():
+                    if self.closed:
+                        raise RuntimeError('the decode pool has been closed')
+                    result.wait(1.0)
+                result.get()
+                out[start:start + len(chunk)] = self.slots[offset:offset + len(chunk)]
+        finally:
+            self.free_blocks.put(block)
+        return out
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pool.terminate()
+            self.pool.join()
+            # the exit hook would keep the pool and its buffer alive until exit
+            atexit.unregister(self.close)
+
+class EpochSampler:
+    '''
+    hands out training indices one batch at a time, every epoch is a fresh
+    permutation of the dataset drawn from seed + epoch, so the batches are
+    reproducible and can be resumed from a step counter.
+    behind a prefetching tf.data pipeline self.step runs ahead of the batches
+    the training loop has used, to resume exactly pass the number of batches
+    the loop has consumed as step, not sampler.step
+    '''
+    def __init__(self, N, batch_size, seed=0, step=0):
+        self.N = N
+        self.batch_size = batch_size
+        self.seed = seed
+        self.step = step
+        if N < batch_size:
+            raise ValueError('the dataset has %d entries, fewer than one batch of %d' % (N, batch_size))
+        # the last incomplete batch of every epoch is dropped
+        self.steps_per_epoch = N // batch_size
+        self.epoch = None
+        self.perm = None
+
+    def permutation(self, epoch):
+        if epoch != self.epoch:
+            self.perm = np.random.RandomState(self.seed + epoch).permutation(self.N)
+            self.epoch = epoch
+        return self.perm
+
+    def next(self):
+        epoch, k = divmod(self.step, self.steps_per_epoch)
+        select = self.permutation(epoch)[k*self.batch_size:(k+1)*self.batch_size]
+        self.step = self.step + 1
+        # sorted, so that the block is read front to back from the stores
+        return np.sort(select)
+
+    def __iter__(self):
+        while True:
+            yield self.next()
 
 class DataLoader:
-    def __init__(self):
+    def __init__(self, num_workers=0, preprocessed=False):
         self.dataset_path = '/Users/xiao.lu/project/KITTI_dataset/' 
+        # preprocess the frame pairs in worker processes when num_workers > 0,
+        # the pool is started on first use so that the workers see dataset_path
+        self.num_workers = num_workers
+        self.decode_pool = None
+        self.pool_lock = threading.Lock()
+        # read the preprocessed frame pairs from <dataset>_frames.npy, see build_frames
+        self.preprocessed = preprocessed
+        self.frames = {}
+        self.lock = threading.Lock()
+        # every dataset is only unpickled once, see load_index, the index has
+        # its own lock since frame_store reads it while holding self.lock
+        self.index = {}
+        self.index_lock = threading.Lock()
 
     def preprocessing(self, data):
-        img_2 = cv2.imread(self.dataset_path+data[3][1])
-        img_1 = cv2.imread(self.dataset_path+data[3][0])
-        img_2 = cv2.resize(img_2, (150, 50), interpolation=cv2.INTER_LINEAR)
-        img_1 = cv2.resize(img_1, (150, 50), interpolation=cv2.INTER_LINEAR)
-        img_2_ = img_2.astype(np.float32)/255.
-        img_1_ = img_1.astype(np.float32)/255.
-        ###########
-        diff = img_2_ - img_1_
-        diff = diff*0.5 + 0.5
-        # diff = (diff * 255).astype(np.uint8)
-        ###########
-        img = np.concatenate((img_2_, diff), axis=-1)
-        return img
-
-    def load_training_data(self, batch_size):
+        return self.preprocess_pair(data[3])
+
+    def preprocess_pair(self, pair):
+        return _preprocess_pair(self.dataset_path, pair)
+
+    def preprocess_batch(self, pairs):
+        if self.num_workers > 0:
+            with self.pool_lock:
+                if self.decode_pool is None:
+                    # a module level function, the loader itself holds locks and cannot be
+                    # pickled for workers that are spawned instead of forked
+                    self.decode_pool = DecodePool(functools.partial(_preprocess_pair, self.dataset_path),
+                                                  (50, 150, 6), np.float32, self.num_workers)
+                decode_pool = self.decode_pool
+            return decode_pool.map(list(pairs))
+        return np.array([self.preprocess_pair(pair) for pair in pairs], dtype=np.float32)
+
+    def close(self):
+        '''
+        stop the preprocessing workers, the next preprocess_batch starts a new pool
+        '''
+        with self.pool_lock:
+            if self.decode_pool is not None:
+                self.decode_pool.close()
+                self.decode_pool = None
+
+    def build_index(self, pkl_path):
+        '''
+        unpickle the dataset and split it into one array per field,
+        the arrays are saved as .npy files into <dataset>_index/ so that
+        later runs can memory-map them instead of unpickling everything,
+        they are written into a temporary directory that only replaces
+        <dataset>_index/ when every file is complete
+        '''
+        with open(pkl_path, 'rb') as f:
+            dataset = pickle.load(f)
+        index = {}
+        index['states_pre'] = np.array([data[0] for data in dataset], dtype=np.float32)
+        index['states_gt'] = np.array([data[1] for data in dataset], dtype=np.float32)
+        index['observation'] = np.array([data[2] for data in dataset], dtype=np.float32)
+        index['pairs'] = np.array([[data[3][0], data[3][1]] for data in dataset])
+        index_path = os.path.splitext(pkl_path)[0] + '_index'
+        tmp_path = index_path + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        try:
+            for key, arr in index.items():
+                np.save(os.path.join(tmp_path, key + '.npy'), arr)
+            if os.path.exists(index_path):
+                shutil.rmtree(index_path)
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return index
+
+    def load_index(self, pkl_path):
+        '''
+        returns the fields of the dataset as arrays indexed by entry,
+        memory-mapped from <dataset>_index/ when it is up to date, the lock
+        keeps loader threads from building it twice
+        '''
+        with self.index_lock:
+            if pkl_path not in self.index:
+                index_path = os.path.splitext(pkl_path)[0] + '_index'
+                keys = ['states_pre', 'states_gt', 'observation', 'pairs']
+                files = [os.path.join(index_path, key + '.npy') for key in keys]
+                if all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(pkl_path) for f in files):
+                    self.index[pkl_path] = {key: np.load(f, mmap_mode='r') for key, f in zip(keys, files)}
+                else:
+                    self.index[pkl_path] = self.build_index(pkl_path)
+            return self.index[pkl_path]
+
+    def build_frames(self, pkl_path):
+        '''
+        run preprocessing once for every entry of the dataset and store the
+        6 channel 50x150 inputs as uint8 in <dataset>_frames.npy, entry idx is
+        row idx. the image channels are stored exactly, the difference channels
+        are off by at most 1/510 after dequantization. the frames are written
+        to a temporary file that only replaces <dataset>_frames.npy when complete
+        '''
+        pairs = self.load_index(pkl_path)['pairs']
+        frames_path = os.path.splitext(pkl_path)[0] + '_frames.npy'
+        tmp_path = frames_path + '.tmp' + str(os.getpid())
+        frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(pairs), 50, 150, 6))
+        block = 256
+        try:
+            for start in range (0, len(pairs), block):
+                img = self.preprocess_batch(pairs[start:start + block])
+                frames[start:start + block] = np.clip(np.round(img * 255.), 0, 255).astype(np.uint8)
+            frames.flush()
+            del frames
+            os.replace(tmp_path, frames_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return frames_path
+
+    def frame_store(self, pkl_path):
+        '''
+        the memory-mapped frame store of the dataset, (re)built when it is
+        missing or older than the dataset. the lock keeps loader threads from
+        building it twice, training_dataset resolves it before its threads start
+        '''
+        with self.lock:
+            if pkl_path not in self.frames:
+                frames_path = os.path.splitext(pkl_path)[0] + '_frames.npy'
+                if not (os.path.exists(frames_path) and
+                        os.path.getmtime(frames_path) >= os.path.getmtime(pkl_path)):
+                    self.build_frames(pkl_path)
+                self.frames[pkl_path] = np.load(frames_path, mmap_mode='r')
+            return self.frames[pkl_path]
+
+    def load_frames(self, pkl_path, select):
+        '''
+        the network inputs of the selected dataset entries, either preprocessed
+        on the fly or read from the memory-mapped frame store
+        '''
+        select = np.asarray(select)
+        if not self.preprocessed:
+            return self.preprocess_batch(self.load_index(pkl_path)['pairs'][select])
+        return self.frame_store(pkl_path)[select].astype(np.float32) / 255.
+
+    def load_training_data(self, batch_size, sampler=None):
         dim_x = 5
         dim_z = 2
-        dataset = pickle.load(open('KITTI_VO_dataset.pkl', 'rb'))
-        select = random.sample(range(0, len(dataset)), batch_size)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        observation_img = []
-
-        for idx in select:
-            states_gt_save.append(dataset[idx][1])
-            states_pre_save.append(dataset[idx][0])
-            observation_save.append(dataset[idx][2])
-            img = self.preprocessing(dataset[idx])
-            observation_img.append(img)
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        observation_img = np.array(observation_img)
+        index = self.load_index('KITTI_VO_dataset.pkl')
+        N = index['pairs'].shape[0]
+        if sampler is None:
+            select = random.sample(range(0, N), batch_size)
+        else:
+            select = sampler.next()
+        states_pre_save = index['states_pre'][select]
+        states_gt_save = index['states_gt'][select]
+        observation_save = index['observation'][select]
+        observation_img = self.load_frames('KITTI_VO_dataset.pkl', select)
 
         # to tensor
         states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
@@ -69,26 +312,50 @@ class DataLoader:
         return states_pre_save, states_gt_save, observation_save, observation_img
 
 
+    def training_dataset(self, batch_size, sampler=None):
+        '''
+        tf.data pipeline that yields the same batches as load_training_data,
+        the frame pairs are preprocessed in parallel and prefetched,
+        the indices of each batch come from sampler (an EpochSampler)
+        '''
+        dim_x = 5
+        dim_z = 2
+        index = self.load_index('KITTI_VO_dataset.pkl')
+        N = index['pairs'].shape[0]
+        states_pre = tf.reshape(tf.convert_to_tensor(index['states_pre'], dtype=tf.float32), [N, 1, dim_x])
+        states_gt = tf.reshape(tf.convert_to_tensor(index['states_gt'], dtype=tf.float32), [N, 1, dim_x])
+        observation = tf.reshape(tf.convert_to_tensor(index['observation'], dtype=tf.float32), [N, 1, dim_z])
+
+        # the frame store is built before the pipeline starts, the map only reads it
+        if self.preprocessed:
+            frames = self.frame_store('KITTI_VO_dataset.pkl')
+            read = lambda idx: frames[idx].astype(np.float32) / 255.
+        else:
+            read = lambda idx: self.preprocess_batch(index['pairs'][idx])
+
+        def load_batch(select):
+            observation_img = tf.numpy_function(read, [select], tf.float32)
+            observation_img.set_shape([batch_size, 50, 150, 6])
+            return (tf.gather(states_pre, select), tf.gather(states_gt, select),
+                    tf.gather(observation, select), observation_img)
+
+        if sampler is None:
+            sampler = EpochSampler(N, batch_size)
+        data = tf.data.Dataset.from_generator(
+            lambda: iter(sampler), output_types=tf.int64, output_shapes=[batch_size])
+        data = data.map(load_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        data = data.prefetch(tf.data.experimental.AUTOTUNE)
+        return data
+
     def load_testing_data(self):
         dim_x = 5
         dim_z = 2
-        dataset = pickle.load(open('KITTI_VO_test.pkl', 'rb'))
-        N = len(dataset)
-        states_gt_save = []
-        states_pre_save = []
-        observation_save = []
-        observation_img = []
-
-        for idx in range(N):
-            states_gt_save.append(dataset[idx][1])
-            states_pre_save.append(dataset[idx][0])
-            observation_save.append(dataset[idx][2])
-            img = self.preprocessing(dataset[idx])
-            observation_img.append(img)
-        states_pre_save = np.array(states_pre_save)
-        states_gt_save = np.array(states_gt_save)
-        observation_save = np.array(observation_save)
-        observation_img = np.array(observation_img)
+        index = self.load_index('KITTI_VO_test.pkl')
+        N = index['pairs'].shape[0]
+        states_pre_save = np.array(index['states_pre'])
+        states_gt_save = np.array(index['states_gt'])
+        observation_save = np.array(index['observation'])
+        observation_img = self.load_frames('KITTI_VO_test.pkl', np.arange(N))
 
         # to tensor
         states_pre_save = tf.convert_to_tensor(states_pre_save, dtype=tf.float32)
@@ -106,46 +373,50 @@ class DataLoader:
         return states_pre_save, states_gt_save, observation_save, observation_img
 
 
-    def format_state(self, state, batch_size, num_ensemble, dim_x):
-        dim_x = dim_x
-        # diag = np.ones((dim_x)).astype(np.float32) * 0.1
-        diag = np.array([0.1, 0.1, 0.1, 0.5, 0.01]).astype(np.float32)
-        diag = diag.astype(np.float32)
-        mean = np.zeros((dim_x))
-        mean = tf.convert_to_tensor(mean, dtype=tf.float32)
-        mean = tf.stack([mean] * batch_size)
-        nd = tfp.distributions.MultivariateNormalDiag(loc=mean, scale_diag=diag)
-        Q = tf.reshape(nd.sample(num_ensemble), [batch_size, num_ensemble, dim_x])
-        for n in range (batch_size):
-            if n == 0:
-                ensemble = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-                ensemble = tf.concat([ensemble, tmp], 0)
-        ensemble = ensemble + Q
+    def format_state(self, state, batch_size, num_ensemble, dim_x, spread=None):
+        '''
+        ensemble of num_ensemble copies of state [batch, 1, dim_x] perturbed by
+        gaussian noise with per dimension std spread (scalar or [dim_x]),
+        built by broadcasting, so it also works inside a tf.function
+        '''
+        if spread is None:
+            # spread = np.ones((dim_x)) * 0.1
+            spread = [0.1, 0.1, 0.1, 0.5, 0.01]
+        spread = tf.cast(spread, tf.float32) * tf.ones([dim_x])
+        state = tf.reshape(tf.cast(state, tf.float32), [-1, 1, dim_x])
+        Q = tf.random.normal([tf.shape(state)[0], num_ensemble, dim_x]) * spread
+        ensemble = tf.tile(state, [1, num_ensemble, 1]) + Q
         state_input = (ensemble, state)
         return state_input
 
-    def format_init_state(self, state, batch_size, num_ensemble, dim_x):
-        dim_x = dim_x
-        # diag = np.ones((dim_x)).astype(np.float32) * 0.1
-        diag = np.array([0.1, 0.1, 0.1, 0.5, 0.01]).astype(np.float32)
-        diag = diag.astype(np.float32)
-        mean = np.zeros((dim_x))
-        mean = tf.convert_to_tensor(mean, dtype=tf.float32)
-        mean = tf.stack([mean] * batch_size)
-        nd = tfp.distributions.MultivariateNormalDiag(loc=mean, scale_diag=diag)
-        Q = tf.reshape(nd.sample(num_ensemble), [batch_size, num_ensemble, dim_x])
-        for n in range (batch_size):
-            if n == 0:
-                ensemble = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([state[n]] * num_ensemble), [1, num_ensemble, dim_x])
-                ensemble = tf.concat([ensemble, tmp], 0)
-        ensemble = ensemble + Q
+    def format_init_state(self, state, batch_size, num_ensemble, dim_x, spread=None):
+        '''
+        same as format_state, used to initialize the test runs
+        '''
+        if spread is None:
+            # spread = np.ones((dim_x)) * 0.1
+            spread = [0.1, 0.1, 0.1, 0.5, 0.01]
+        spread = tf.cast(spread, tf.float32) * tf.ones([dim_x])
+        state = tf.reshape(tf.cast(state, tf.float32), [-1, 1, dim_x])
+        Q = tf.random.normal([tf.shape(state)[0], num_ensemble, dim_x]) * spread
+        ensemble = tf.tile(state, [1, num_ensemble, 1]) + Q
         state_input = (ensemble, state)
         return state_input
 
+    def pad_trajectories(self, trajectories):
+        '''
+        packs trajectories of different lengths, each [T_i, ...], into one
+        batch [T_max, num_trajectories, ...] for FilterStep.masked_rollout,
+        the short ones are padded with their last step,
+        mask [T_max, num_trajectories] is False on the padded steps
+        '''
+        trajectories = [np.asarray(traj) for traj in trajectories]
+        T = max(traj.shape[0] for traj in trajectories)
+        padded = np.stack([np.concatenate([traj, np.repeat(traj[-1:], T - traj.shape[0], axis=0)])
+                           for traj in trajectories], axis=1)
+        mask = np.stack([np.arange(T) < traj.shape[0] for traj in trajectories], axis=1)
+        return padded, mask
+
 
 # DataLoader_func = DataLoader()
 # states_pre_save, states_gt_save, observation_save, observation_img = DataLoader_func.load_training_data(
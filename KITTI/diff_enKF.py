@@ -108,7 +108,8 @@ class ProcessModel(tf.keras.Model):
             name='process_fc3')
 
     def call(self, last_state, training):
-        last_state = tf.reshape(last_state, [self.batch_size * self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(last_state)[1]
+        last_state = tf.reshape(last_state, [-1, self.dim_x])
 
         fc1 = self.process_fc1(last_state)
         fcadd1 = self.process_fc_add1(fc1)
@@ -117,7 +118,7 @@ class ProcessModel(tf.keras.Model):
         update = self.process_fc3(fcadd2)
 
         new_state = last_state + update
-        new_state = tf.reshape(new_state, [self.batch_size, self.num_ensemble, self.dim_x])
+        new_state = tf.reshape(new_state, [-1, num_ensemble, self.dim_x])
 
         return new_state
 
@@ -157,10 +158,11 @@ class BayesianProcessModel(tf.keras.Model):
             name='process_fc3')
 
     def call(self, last_state):
-        last_state = tf.reshape(last_state, [self.batch_size * self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(last_state)[1]
+        last_state = tf.reshape(last_state, [-1, self.dim_x])
 
         # we pass the action into the process model with the cosine and sine
-        theta = tf.reshape(last_state[:,2], [self.batch_size * self.num_ensemble, 1])
+        theta = tf.reshape(last_state[:,2], [-1, 1])
         theta = -(theta-np.pi/2)
         st = tf.sin(theta)
         ct = tf.cos(theta)
@@ -173,7 +175,7 @@ class BayesianProcessModel(tf.keras.Model):
         update = self.process_fc3(fcadd2)
 
         new_state = last_state + update
-        new_state = tf.reshape(new_state, [self.batch_size, self.num_ensemble, self.dim_x])
+        new_state = tf.reshape(new_state, [-1, num_ensemble, self.dim_x])
 
         return new_state
 
@@ -227,14 +229,15 @@ class ObservationModel(tf.keras.Model):
             name='observation_fc3')
 
     def call(self, state):
-        state = tf.reshape(state, [self.batch_size* self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(state)[1]
+        state = tf.reshape(state, [-1, self.dim_x])
 
         fc1 = self.observation_fc1(state)
         fcadd1 = self.observation_fc_add1(fc1)
         fc2 = self.observation_fc2(fcadd1)
         fcadd2 = self.observation_fc_add2(fc2)
         z_pred = self.observation_fc3(fcadd2)
-        z_pred = tf.reshape(z_pred, [self.batch_size, self.num_ensemble, self.dim_z])
+        z_pred = tf.reshape(z_pred, [-1, num_ensemble, self.dim_z])
 
         return z_pred
 
@@ -245,12 +248,16 @@ class BayesianImageSensorModel(tf.keras.Model):
     the representation can be explainable or latent.  
     observation = [batch_size, img_h, img_w, channel]
     encoding = [batch_size, dim_fc3]
+    with shared_features=True the conv features stay at [batch_size, num_feature]
+    and the first bayesian layer is sampled per ensemble member from them
+    (see shared_fc1) instead of running it on num_ensemble tiled copies
     '''
-    def __init__(self, batch_size, num_ensemble, dim_z):
+    def __init__(self, batch_size, num_ensemble, dim_z, shared_features=False):
         super(BayesianImageSensorModel, self).__init__()
         self.batch_size = batch_size
         self.dim_z = dim_z
         self.num_ensemble = num_ensemble
+        self.shared_features = shared_features
 
     def build(self, input_shape):
         self.sensor_conv1 = tf.keras.layers.Conv2D(
@@ -310,7 +317,28 @@ class BayesianImageSensorModel(tf.keras.Model):
             activation=None,
             name='bayes_sensor_fc4')
 
-    def call(self, image):
+    def shared_fc1(self, inputs, num_ensemble):
+        '''
+        bayes_sensor_fc1 for all ensemble members from the shared features
+        inputs = [batch_size, num_feature] by local reparameterization:
+        with a gaussian kernel x W is gaussian with mean x W_mu + b and
+        variance x^2 sigma^2, one sample of it is drawn per ensemble member,
+        returns [batch_size*num_ensemble, units] like the tiled path
+        '''
+        layer = self.bayes_sensor_fc1
+        if not layer.built:
+            layer.build(inputs.shape)
+        kernel = layer.kernel_posterior.distribution
+        mean = tf.matmul(inputs, kernel.loc) + layer.bias_posterior_tensor_fn(layer.bias_posterior)
+        # the ReLU features can be all zero, the epsilon keeps the gradient of the sqrt finite
+        std = tf.sqrt(tf.matmul(tf.square(inputs), tf.square(kernel.scale)) + 1e-12)
+        eps = tf.random.normal([tf.shape(inputs)[0], num_ensemble, layer.units])
+        fc1 = tf.expand_dims(mean, 1) + tf.expand_dims(std, 1) * eps
+        return layer.activation(tf.reshape(fc1, [-1, layer.units]))
+
+    def call(self, image, num_ensemble=None):
+        if num_ensemble is None:
+            num_ensemble = self.num_ensemble
         conv1 = self.sensor_conv1(image)
         conv1 = tf.nn.max_pool2d(conv1, 2, 2, padding='SAME')
         conv2 = self.sensor_conv2(conv1)
@@ -322,27 +350,25 @@ class BayesianImageSensorModel(tf.keras.Model):
         inputs = self.flatten(conv4)
         num_feature = inputs.shape[1]
 
-        # expand to ensembles
-        for i in range (self.batch_size):
-            if i == 0:
-                inputs_z = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-            else:
-                tmp = tf.reshape(tf.stack([inputs[i]] * self.num_ensemble), [1, self.num_ensemble, num_feature])
-                inputs_z = tf.concat([inputs_z, tmp], 0)
+        if self.shared_features:
+            fc1 = self.shared_fc1(inputs, num_ensemble)
+        else:
+            # expand to ensembles
+            inputs_z = tf.repeat(inputs, num_ensemble, axis=0)
 
-        # make sure the ensemble shape matches
-        inputs_z = tf.reshape(inputs_z, [self.batch_size * self.num_ensemble, num_feature])
+            # make sure the ensemble shape matches
+            inputs_z = tf.reshape(inputs_z, [-1, num_feature])
 
-        fc1 = self.bayes_sensor_fc1(inputs_z)
+            fc1 = self.bayes_sensor_fc1(inputs_z)
         fc2 = self.bayes_sensor_fc2(fc1)
         fc3 = self.bayes_sensor_fc3(fc2)
         observation = self.bayes_sensor_fc4(fc3)
-        encoding = fcadd2
+        encoding = fc3
 
-        observation = tf.reshape(observation, [self.batch_size, self.num_ensemble, self.dim_z])
+        observation = tf.reshape(observation, [-1, num_ensemble, self.dim_z])
         observation_m = tf.reduce_mean(observation, axis = 1)
 
-        encoding = tf.reshape(encoding, [self.batch_size, self.num_ensemble, 32])
+        encoding = tf.reshape(encoding, [-1, num_ensemble, 32])
         encoding = tf.reduce_mean(encoding, axis = 1)
 
         return observation, observation_m, encoding
@@ -360,13 +386,18 @@ class ObservationNoise(tf.keras.Model):
     observation vector z is with size 2, the R has the size
     2 + (64 -> fc 2 -> 2) + fixed noise,
     the result is the diag of R where R is a 2x2 matrix
+    with dense=False R is kept structured, R = diag(diag) + U U^T, and the
+    model returns (U, diag) with a learned low-rank factor U = [batch_size,
+    dim_z, rank] (None if rank is 0) instead of (R, diag)
     '''
-    def __init__(self, batch_size, num_ensemble, dim_z, r_diag):
+    def __init__(self, batch_size, num_ensemble, dim_z, r_diag, dense=True, rank=0):
         super(ObservationNoise, self).__init__()
         self.batch_size = batch_size
         self.num_ensemble = num_ensemble
         self.dim_z = dim_z
         self.r_diag = r_diag
+        self.dense = dense
+        self.rank = rank
 
     def build(self, input_shape):
         constant = np.ones(self.dim_z)* 1e-3
@@ -399,6 +430,15 @@ class ObservationNoise(tf.keras.Model):
             regularizer = tf.keras.regularizers.l2(l=1e-3),
             initializer = tf.constant_initializer(init))
 
+        if self.rank > 0:
+            self.observation_noise_factor = tf.keras.layers.Dense(
+                units=self.dim_z * self.rank,
+                activation=None,
+                kernel_initializer=tf.initializers.glorot_normal(),
+                kernel_regularizer=tf.keras.regularizers.l2(l=1e-3),
+                bias_regularizer=tf.keras.regularizers.l2(l=1e-3),
+                name='observation_noise_factor')
+
     def call(self, inputs, learn):
         if learn == True:
             diag = self.observation_noise_fc1(inputs)
@@ -406,12 +446,20 @@ class ObservationNoise(tf.keras.Model):
             diag = tf.square(diag + self.learned_observation_noise_bias)
         else:
             diag = tf.square(self.learned_observation_noise_bias)
-            diag = tf.stack([diag] * (self.batch_size))
+            diag = tf.tile(diag[None, :], [tf.shape(inputs)[0], 1])
 
         diag = diag + self.fixed_observation_noise_bias
+        diag = tf.reshape(diag, [-1, self.dim_z])
+
+        if self.dense == False:
+            U = None
+            if self.rank > 0 and learn == True:
+                U = self.observation_noise_factor(inputs)
+                U = tf.reshape(U, [-1, self.dim_z, self.rank])
+            return U, diag
+
         R = tf.linalg.diag(diag)
-        R = tf.reshape(R, [self.batch_size, self.dim_z, self.dim_z])
-        diag = tf.reshape(diag, [self.batch_size, self.dim_z])
+        R = tf.reshape(R, [-1, self.dim_z, self.dim_z])
 
         return R, diag
 
@@ -456,6 +504,37 @@ class getloss():
 
         return loss
 
+    def _masked_mse(self, diff, mask):
+        """
+        _mse over the elements of the batch where mask is True, the other
+        elements add nothing to the loss or its gradient. their difference is
+        replaced before the square root, a zero there has no finite gradient
+        Parameters
+        ----------
+        diff : tensor
+            difference between label and prediction [batch_size, 1, dim]
+        mask : tensor
+            [batch_size] (bool)
+        Returns
+        -------
+        loss : tensor
+            the mean squared error plus euclidean distance of the valid
+            elements, 0 if there are none
+        """
+        mask = tf.reshape(mask, [-1, 1])
+        diff = tf.where(tf.expand_dims(mask, axis=-1), diff, tf.ones_like(diff))
+        loss = tf.reduce_sum(tf.square(diff), axis=-1)
+
+        # the loss needs to be finite
+        loss = tf.where(tf.math.is_finite(loss), loss,
+                        tf.ones_like(loss)*1e20)
+        dist = tf.sqrt(loss)
+
+        weight = tf.cast(mask, tf.float32)
+        loss = tf.reduce_sum(weight * (loss + dist)) / tf.maximum(tf.reduce_sum(weight), 1.)
+
+        return loss
+
 class utils:
     def __init__(self):
         super(utils, self).__init__()
@@ -525,8 +604,8 @@ class utils:
         """
         # eliminate nans and infs (replace them with high values on the
         # diagonal and zeros else)
-        bs = covar.get_shape()[0]
-        dim = covar.get_shape()[-1]
+        bs = tf.shape(covar)[0]
+        dim = tf.shape(covar)[-1]
         covar = tf.where(tf.math.is_finite(covar), covar,
                          tf.eye(dim, batch_shape=[bs])*1e6)
 
@@ -535,7 +614,7 @@ class utils:
 
         # add a bit of noise to the diagonal of covar to prevent
         # nans in the gradient of the svd
-        noise = tf.random.uniform(covar.get_shape().as_list()[:-1], minval=0,
+        noise = tf.random.uniform(tf.shape(covar)[:-1], minval=0,
                                   maxval=0.001/self.scale**2)
         s, u, v = tf.linalg.svd(covar + tf.linalg.diag(noise))
         # test if the matrix is invertible
@@ -547,7 +626,7 @@ class utils:
         # the minimum eigenvalue is at least 1e-4/self.scale
         min_eig = s[..., -1:]
         eps = tf.tile(tf.maximum(1e-4/self.scale - min_eig, 0),
-                      [1, s.get_shape()[-1] ])
+                      [1, tf.shape(s)[-1] ])
         covar_invertible = tf.matmul(u, tf.matmul(tf.linalg.diag(s + eps), v,
                                                   adjoint_b=True))
 
@@ -561,6 +640,64 @@ class utils:
             (covar_valid + tf.linalg.matrix_transpose(covar_valid)) / 2.
 
         return covar_valid
+
+    def _cholesky(self, covar, jitter=1e-6):
+        """
+        Cholesky factor of a batch of covariance matrices that stays usable
+        in graph mode:
+          - the matrix is made symmetric, nans and infs are replaced like in
+            _make_valid and a small jitter relative to the mean diagonal is
+            added, then it is factored directly. the matrices of the update
+            are I + PSD or (N-1)I + PSD, so this is the path that runs
+          - only if the batch had non-finite entries the tf.cond branch of
+            _clip_eigenvalues computes a repair. the repair is not
+            differentiated, the gradient is passed straight through to the
+            matrix, so no gradient flows through the cond and the train step
+            also compiles with XLA
+        Parameters
+        ----------
+        covar : tensor
+            a batch of covariance matrices [batch_size, dim, dim]
+        jitter : float, optional
+            diagonal offset relative to the mean of the diagonal
+        Returns
+        -------
+        chol : tensor
+            the lower triangular cholesky factors of the (repaired) matrices
+        """
+        dim = tf.shape(covar)[-1]
+        eye = tf.eye(dim, dtype=covar.dtype)
+        covar = (covar + tf.linalg.matrix_transpose(covar)) / 2.
+        finite = tf.math.is_finite(covar)
+        covar = tf.where(finite, covar, tf.zeros_like(covar) + eye*1e6)
+        scale = tf.reduce_mean(tf.abs(tf.linalg.diag_part(covar)), axis=-1)
+        covar = covar + eye * (jitter * scale + 1e-12)[:, None, None]
+        covar_fixed = tf.stop_gradient(covar)
+        repair = tf.cond(tf.reduce_all(finite),
+                         lambda: tf.zeros_like(covar_fixed),
+                         lambda: self._clip_eigenvalues(covar_fixed) - covar_fixed)
+        chol = tf.linalg.cholesky(covar + repair)
+        return chol
+
+    def _clip_eigenvalues(self, covar):
+        """
+        clips the eigenvalues of a batch of symmetric matrices to at least
+        1e-4/self.scale (the minimum _make_valid enforces). unlike _make_valid
+        this works for matrices whose size is only known at runtime
+        Parameters
+        ----------
+        covar : tensor
+            a batch of symmetric matrices [batch_size, dim, dim]
+        Returns
+        -------
+        covar_valid : tensor
+            the repaired matrices
+        """
+        s, u = tf.linalg.eigh(covar)
+        s_valid = tf.maximum(s, 1e-4/self.scale)
+        covar_valid = tf.matmul(u * s_valid[..., None, :], u, adjoint_b=True)
+        covar_valid = (covar_valid + tf.linalg.matrix_transpose(covar_valid)) / 2.
+        return covar_valid
     ###########################################################################
 
 class bayesiantransition(tf.keras.Model):
@@ -585,9 +722,11 @@ class bayesiantransition(tf.keras.Model):
 
         state_old, m_state = input_states
 
-        state_old = tf.reshape(state_old, [self.batch_size, self.num_ensemble, self.dim_x])
+        num_ensemble = tf.shape(state_old)[1]
+
+        state_old = tf.reshape(state_old, [-1, num_ensemble, self.dim_x])
 
-        m_state = tf.reshape(m_state, [self.batch_size, self.dim_x])
+        m_state = tf.reshape(m_state, [-1, self.dim_x])
 
         # get prediction and noise of next state
         training = True
@@ -596,9 +735,9 @@ class bayesiantransition(tf.keras.Model):
         # the ensemble state mean
         m_state = tf.reduce_mean(state_pred, axis = 1)
 
-        ensemble = tf.reshape(state_pred, [self.batch_size, self.num_ensemble, self.dim_x])
+        ensemble = tf.reshape(state_pred, [-1, num_ensemble, self.dim_x])
 
-        m_state = tf.reshape(m_state, [self.batch_size, 1, self.dim_x])
+        m_state = tf.reshape(m_state, [-1, 1, self.dim_x])
 
         # tuple structure of updated state
         output = (ensemble, m_state)
@@ -621,20 +760,21 @@ class StandaloneModel(tf.keras.Model):
 
         self.dropout_rate = dropout_rate
 
-        # learned sensor model
-        self.sensor_model = BayesianSensorModelBranching(self.batch_size, self.num_ensemble, self.dim_z)
+        # learned sensor model, the frames of all inputs are stacked along the channels
+        self.sensor_model = BayesianImageSensorModel(self.batch_size, self.num_ensemble, self.dim_z)
 
-    def call(self, inputs):
+    def call(self, inputs, num_ensemble=None):
 
-        raw_sensor1, raw_sensor2 = inputs
+        if num_ensemble is None:
+            num_ensemble = self.num_ensemble
+        raw_sensor = tf.concat(tf.nest.flatten(inputs), axis = -1)
 
         # get sensor reading
-        training = True
-        ensemble_z, z, encoding = self.sensor_model(raw_sensor1, raw_sensor2, training, learn = True)
+        ensemble_z, z, encoding = self.sensor_model(raw_sensor, num_ensemble = num_ensemble)
 
-        z = tf.reshape(z, [self.batch_size, 1, self.dim_z])
+        z = tf.reshape(z, [-1, 1, self.dim_z])
 
-        ensemble_z = tf.reshape(ensemble_z, [self.batch_size, self.num_ensemble, self.dim_z])
+        ensemble_z = tf.reshape(ensemble_z, [-1, num_ensemble, self.dim_z])
 
         # tuple structure of updated state
         output = (ensemble_z, z)
@@ -643,16 +783,141 @@ class StandaloneModel(tf.keras.Model):
 
 
 
+class enKFUpdate(tf.keras.Model):
+    '''
+    the ensemble kalman update shared by enKFMLP and MultiRateEnKF,
+    subclasses build their own models and call set_update_mode
+    '''
+    def set_update_mode(self, update_mode, noise_rank, filter_type='enkf'):
+        # 'dense' solves with the dim_z x dim_z innovation matrix, 'ensemble'
+        # works in the num_ensemble dimensional ensemble subspace, 'auto'
+        # picks whichever of the two is smaller for the constructor's num_ensemble
+        if update_mode == 'auto':
+            update_mode = 'ensemble' if self.dim_z > self.num_ensemble + noise_rank else 'dense'
+        if update_mode not in ['dense', 'ensemble']:
+            raise ValueError('unknown update_mode: ' + str(update_mode))
+        self.update_mode = update_mode
+
+        # 'enkf' updates every member with the sensor ensemble as perturbed
+        # observations, 'etkf' transforms the ensemble, see transform_update
+        if filter_type not in ['enkf', 'etkf']:
+            raise ValueError('unknown filter_type: ' + str(filter_type))
+        self.filter_type = filter_type
+
+    def innovation_solve(self, H_A, diag_R, y_bar, U_R=None):
+        '''
+        returns innovation^-1 y_bar with innovation = H_A^T H_A / (N-1) + R,
+        H_A = [batch_size, num_ensemble, dim_z], y_bar = [batch_size, dim_z, num_ensemble]
+        R = diag(diag_R) + U_R U_R^T is never formed, everything is whitened
+        with R_diag^-1/2 first, the low-rank factor is appended to the
+        whitened ensemble Y, so the whitened innovation is Y Y^T / (N-1) + I.
+        in ensemble mode the Woodbury identity replaces the dim_z x dim_z
+        solve by a (num_ensemble + rank) dimensional one:
+        (Y Y^T / (N-1) + I)^-1 = I - Y ((N-1) I + Y^T Y)^-1 Y^T
+        '''
+        N = tf.cast(tf.shape(H_A)[1], tf.float32)
+        R_isqrt = tf.expand_dims(tf.math.rsqrt(diag_R), axis = -1)
+        Y = R_isqrt * tf.transpose(H_A, perm=[0,2,1])
+        if U_R is not None:
+            Y = tf.concat([Y, tf.sqrt(N -1) * R_isqrt * U_R], axis = -1)
+        y_w = R_isqrt * y_bar
+        if self.update_mode == 'dense':
+            innovation = tf.matmul(Y, Y, transpose_b=True) / (N -1) + tf.eye(tf.shape(Y)[1])
+            innovation_chol = self.utils_._cholesky(innovation)
+            innovation_y = tf.linalg.cholesky_solve(innovation_chol, y_w)
+        else:
+            core = tf.matmul(Y, Y, transpose_a=True) + (N -1) * tf.eye(tf.shape(Y)[-1])
+            core_chol = self.utils_._cholesky(core)
+            core_y = tf.linalg.cholesky_solve(core_chol, tf.matmul(Y, y_w, transpose_a=True))
+            innovation_y = y_w - tf.matmul(Y, core_y)
+        return R_isqrt * innovation_y
+
+    def transform_update(self, state_pred, H_X, z, U_R, diag_R):
+        '''
+        ensemble transform (square root) update without perturbed observations,
+        with the whitened observation anomalies Y = R^-1/2 H_A^T the N x N
+        matrix Pa = ((N-1) I + Y^T Y)^-1 gives the mean weights
+        w = Pa Y^T R^-1/2 (z - mean(H_X)) and the anomaly transform
+        W = ((N-1) Pa)^1/2, the new ensemble is x_a = mean(x) + X (w + W).
+        the symmetric square root is taken with an eigh in float64, so the
+        gradient stays finite when eigenvalues repeat (dim_z < num_ensemble)
+        '''
+        N = tf.shape(state_pred)[1]
+        n = tf.cast(N -1, tf.float32)
+        m_H = tf.reduce_mean(H_X, axis = 1)
+        H_A = H_X - tf.expand_dims(m_H, axis = 1)
+        R_isqrt = tf.expand_dims(tf.math.rsqrt(diag_R), axis = -1)
+        Y = R_isqrt * tf.transpose(H_A, perm=[0,2,1])
+        d = R_isqrt * tf.expand_dims(tf.reshape(z, [-1, self.dim_z]) - m_H, axis = -1)
+        C = tf.matmul(Y, Y, transpose_a=True)
+        g = tf.matmul(Y, d, transpose_a=True)
+        if U_R is not None:
+            # R^-1 = R_diag^-1/2 (I + U U^T)^-1 R_diag^-1/2 with the whitened
+            # factor U, the inverse is taken through the rank x rank core
+            U = R_isqrt * U_R
+            core = tf.matmul(U, U, transpose_a=True) + tf.eye(tf.shape(U)[-1])
+            core_chol = self.utils_._cholesky(core)
+            UY = tf.matmul(U, Y, transpose_a=True)
+            C = C - tf.matmul(UY, tf.linalg.cholesky_solve(core_chol, UY), transpose_a=True)
+            g = g - tf.matmul(UY, tf.linalg.cholesky_solve(core_chol, tf.matmul(U, d, transpose_a=True)),
+                              transpose_a=True)
+        M = n * tf.eye(N) + (C + tf.transpose(C, perm=[0,2,1])) / 2.
+        s, V = tf.linalg.eigh(tf.cast(M, tf.float64))
+        s = tf.expand_dims(s, axis = 1)
+        Pa = tf.matmul(V / s, V, transpose_b=True)
+        W = tf.matmul(V * tf.sqrt(tf.cast(n, tf.float64) / s), V, transpose_b=True)
+        Pa = tf.cast(Pa, tf.float32)
+        W = tf.cast(W, tf.float32)
+        w = tf.matmul(Pa, g)
+
+        # A matrix, the columns of X (w + W) are the rows of (w + W)^T A
+        m_A = tf.reduce_mean(state_pred, axis = 1, keepdims = True)
+        A = state_pred - m_A
+        return m_A + tf.matmul(w + W, A, transpose_a=True)
+
+    def update(self, state_pred, H_X, ensemble_z, U_R, diag_R):
+        '''
+        updates the predicted ensemble state_pred = [batch_size, num_ensemble, dim_x]
+        with the observation ensemble ensemble_z and the predicted observations
+        H_X = [batch_size, num_ensemble, dim_z], R = diag(diag_R) + U_R U_R^T
+        '''
+        if self.filter_type == 'etkf':
+            z = tf.reduce_mean(ensemble_z, axis = 1)
+            return self.transform_update(state_pred, H_X, z, U_R, diag_R)
+
+        num_ensemble = tf.shape(state_pred)[1]
+        H_A = H_X - tf.reduce_mean(H_X, axis = 1, keepdims = True)
+
+        # the measurement y
+        y = tf.transpose(ensemble_z, perm=[0,2,1])
+        final_H_X = tf.transpose(H_X, perm=[0,2,1])
+
+        # A matrix
+        m_A = tf.reduce_mean(state_pred, axis = 1, keepdims = True)
+        A = state_pred - m_A
+        A = tf.transpose(A, perm = [0,2,1])
+
+        # update state of each ensemble, the Kalman gain
+        # K = A H_A innovation^-1 / (N-1) is applied to y_bar through a
+        # solve instead of inverting the innovation matrix
+        y_bar = y - final_H_X
+        innovation_y = self.innovation_solve(H_A, diag_R, y_bar, U_R)
+        K_y = tf.matmul(A, tf.matmul(H_A, innovation_y)) / tf.cast(num_ensemble -1, tf.float32)
+        return state_pred +  tf.transpose(K_y, perm=[0,2,1])
+
+
 # Xiao's version
-class enKFMLP(tf.keras.Model):
-    def __init__(self, batch_size, num_ensemble, dropout_rate,**kwargs):
+class enKFMLP(enKFUpdate):
+    def __init__(self, batch_size, num_ensemble, dropout_rate, update_mode='auto', noise_rank=0, filter_type='enkf',
+                 shared_features=False, **kwargs):
         super(enKFMLP, self).__init__()
 
         # initialization
         self.batch_size = batch_size
         self.num_ensemble = num_ensemble
         
-        self.dim_x = 2
+        # state and observations of the KITTI visual odometry setup (see BayesianProcessModel)
+        self.dim_x = 5
         self.dim_z = 2
 
         self.jacobian = True
@@ -662,111 +927,368 @@ class enKFMLP(tf.keras.Model):
 
         self.dropout_rate = dropout_rate
 
-        self.bayesian_process_model = BayesianProcessModel(self.batch_size, self.num_ensemble, self.dim_x, self.jacobian, self.dropout_rate)
+        self.bayesian_process_model = BayesianProcessModel(self.batch_size, self.num_ensemble, self.dim_x)
 
         # learned observation model
-        self.observation_model = ObservationModel(self.batch_size, self.num_ensemble, self.dim_x, self.dim_z, self.jacobian)
+        self.observation_model = ObservationModel(self.batch_size, self.num_ensemble, self.dim_x, self.dim_z)
 
         # learned observation noise
-        self.observation_noise_model = ObservationNoise(self.batch_size, self.num_ensemble, self.dim_z, self.r_diag, self.jacobian)
+        # R is kept as diagonal (plus low-rank) factors, see innovation_solve
+        self.observation_noise_model = ObservationNoise(self.batch_size, self.num_ensemble, self.dim_z, self.r_diag,
+                                                        dense=False, rank=noise_rank)
 
-        # learned sensor model
-        self.sensor_model = BayesianSensorModelBranching(self.batch_size, self.num_ensemble, self.dim_z)
+        # learned sensor model, the frames of all inputs are stacked along the channels
+        self.sensor_model = BayesianImageSensorModel(self.batch_size, self.num_ensemble, self.dim_z,
+                                                     shared_features=shared_features)
 
         self.utils_ = utils()
 
-    def call(self, inputs, states):
+        self.set_update_mode(update_mode, noise_rank, filter_type)
+
+    def call(self, inputs, states, observed=None):
         # decompose inputs and states
-        raw_sensor1, raw_sensor2 = inputs
+        # observed = [batch_size] (bool) is False for the elements without an
+        # observation at this step, those keep the prediction as the new state
+        raw_sensor = tf.concat(tf.nest.flatten(inputs), axis = -1)
 
         state_old, m_state = states
 
-        state_old = tf.reshape(state_old, [self.batch_size, self.num_ensemble, self.dim_x])
+        # the ensemble size is taken from the states, not from the constructor
+        num_ensemble = tf.shape(state_old)[1]
 
-        m_state = tf.reshape(m_state, [self.batch_size, self.dim_x])
+        state_old = tf.reshape(state_old, [-1, num_ensemble, self.dim_x])
+
+        m_state = tf.reshape(m_state, [-1, self.dim_x])
 
 
         # get prediction and noise of next state
-        training = True
-        state_pred = self.bayesian_process_model(state_old, training)
+        state_pred = self.bayesian_process_model(state_old)
 
 
         # update step
         # get predicted observations
-        learn = True
-        H_X = self.observation_model(state_pred, training, learn)
+        H_X = self.observation_model(state_pred)
 
         # get the emsemble mean of the observations
         m = tf.reduce_mean(H_X, axis = 1)
-        for i in range (self.batch_size):
-            if i == 0:
-                mean = tf.reshape(tf.stack([m[i]] * self.num_ensemble), [self.num_ensemble, self.dim_z])
-            else:
-                tmp = tf.reshape(tf.stack([m[i]] * self.num_ensemble), [self.num_ensemble, self.dim_z])
-                mean = tf.concat([mean, tmp], 0)
-
-        mean = tf.reshape(mean, [self.batch_size, self.num_ensemble, self.dim_z])
-        H_A = H_X - mean
-
-        final_H_A = tf.transpose(H_A, perm=[0,2,1])
-        final_H_X = tf.transpose(H_X, perm=[0,2,1])
 
         # get sensor reading
-        ensemble_z, z, encoding = self.sensor_model(raw_sensor1, raw_sensor2, training, learn = True)
+        ensemble_z, z, encoding = self.sensor_model(raw_sensor, num_ensemble = num_ensemble)
 
         # get observation noise
-        R, diag_R = self.observation_noise_model(encoding, training, True)
+        U_R, diag_R = self.observation_noise_model(encoding, True)
 
+        # update state of each ensemble
+        state_new = self.update(state_pred, H_X, ensemble_z, U_R, diag_R)
+        if observed is not None:
+            state_new = tf.where(tf.reshape(observed, [-1, 1, 1]), state_new, state_pred)
 
-        # the measurement y
-        y = ensemble_z
-        y = tf.transpose(y, perm=[0,2,1])
+        # the ensemble state mean
+        m_state_new = tf.reduce_mean(state_new, axis = 1)
 
-        # calculated innovation matrix s
-        innovation = (1/(self.num_ensemble -1)) * tf.matmul(final_H_A,  H_A) + R
+        m_state_new = tf.reshape(m_state_new, [-1, 1, self.dim_x])
 
-        # A matrix
-        m_A = tf.reduce_mean(state_pred, axis = 1)
-        for i in range (self.batch_size):
-            if i == 0:
-                mean_A = tf.reshape(tf.stack([m_A[i]] * self.num_ensemble), [1, self.num_ensemble, self.dim_x])
-            else:
-                tmp = tf.reshape(tf.stack([m_A[i]] * self.num_ensemble), [1, self.num_ensemble, self.dim_x])
-                mean_A = tf.concat([mean_A, tmp], 0)
-        A = state_pred - mean_A
-        A = tf.transpose(A, perm = [0,2,1])
+        m_state_pred = tf.reduce_mean(state_pred, axis = 1)
 
-        try:
-            innovation_inv = tf.linalg.inv(innovation)
-        except:
-            innovation = self.utils_._make_valid(innovation)
-            innovation_inv = tf.linalg.inv(innovation)
+        m_state_pred = tf.reshape(m_state_pred, [-1, 1, self.dim_x])
 
-        # calculating Kalman gain
-        K = (1/(self.num_ensemble -1)) * tf.matmul(tf.matmul(A, H_A), innovation_inv)
+        z = tf.reshape(z, [-1, 1, self.dim_z])
 
-        # update state of each ensemble
-        y_bar = y - final_H_X
-        state_new = state_pred +  tf.transpose(tf.matmul(K, y_bar), perm=[0,2,1])
+        ensemble_z = tf.reshape(ensemble_z, [-1, num_ensemble, self.dim_z])
 
-        # the ensemble state mean
-        m_state_new = tf.reduce_mean(state_new, axis = 1)
+        m = tf.reshape(m, [-1, 1, self.dim_z])
 
-        m_state_new = tf.reshape(m_state_new, [self.batch_size, 1, self.dim_x])
+        # tuple structure of updated state
+        output = (state_new, m_state_new, m_state_pred, z, ensemble_z, m)
 
-        m_state_pred = tf.reduce_mean(state_pred, axis = 1)
+        return output
+
+    def rollout(self, observations, init_states, mask=None):
+        '''
+        runs the filter over a whole sequence inside one tf.scan,
+        observations = [T, batch_size, ...] (a tuple of them for several sensors),
+        init_states = (ensemble, m_state), returns the outputs of every step
+        stacked along a leading time axis.
+        mask = [T, batch_size] (bool) marks the valid steps when trajectories of
+        different lengths are packed into one batch, on the padded steps the
+        states are carried over unchanged
+        '''
+        ensemble, m_state = init_states
+        batch_size = tf.shape(ensemble)[0]
+        num_ensemble = tf.shape(ensemble)[1]
+        m_state = tf.reshape(m_state, [-1, 1, self.dim_x])
+        initializer = (ensemble, m_state, m_state, tf.zeros([batch_size, 1, self.dim_z]),
+                       tf.zeros([batch_size, num_ensemble, self.dim_z]),
+                       tf.zeros([batch_size, 1, self.dim_z]))
+
+        if mask is None:
+            mask = tf.ones([tf.shape(tf.nest.flatten(observations)[0])[0], tf.shape(ensemble)[0]], tf.bool)
+
+        def step(output, inputs):
+            raw_sensor, valid = inputs
+            out = self.call(raw_sensor, (output[0], output[1]))
+            valid = tf.reshape(valid, [-1, 1, 1])
+            return (tf.where(valid, out[0], output[0]),
+                    tf.where(valid, out[1], output[1])) + tuple(out[2:])
+
+        return tf.scan(step, (observations, mask), initializer=initializer)
+
+
+class MultiRateEnKF(enKFUpdate):
+    '''
+    event driven fusion of image streams that arrive at their own rates,
+    each stream has its own sensor, observation and noise model.
+    propagate(states) is the prediction at the process rate,
+    correct(i, raw_sensor, states, observed) updates the ensemble with a frame
+    of sensor i, observed = [batch_size] (bool) masks elements without one,
+    the sensors that deliver at the same step are applied one after another.
+    call(inputs, states, arrived) runs a whole step for training (see
+    MultiRateRunner.train_step), with inputs = (raw_sensor_1, ..., raw_sensor_n)
+    and arrived = [batch_size, num_sensors], it runs every sensor and masks the
+    updates, MultiRateRunner.run only runs the sensors that delivered
+    '''
+    def __init__(self, batch_size, num_ensemble, dropout_rate, num_sensors=2, update_mode='auto', noise_rank=0, filter_type='enkf',
+                 shared_features=False, **kwargs):
+        super(MultiRateEnKF, self).__init__()
+
+        # initialization
+        self.batch_size = batch_size
+        self.num_ensemble = num_ensemble
+        self.num_sensors = num_sensors
+
+        # state and observations of the KITTI visual odometry setup (see BayesianProcessModel)
+        self.dim_x = 5
+        self.dim_z = 2
+
+        self.jacobian = True
+
+        self.r_diag = np.ones((self.dim_z)).astype(np.float32) * 0.1
+        self.r_diag = self.r_diag.astype(np.float32)
+
+        self.dropout_rate = dropout_rate
+
+        self.bayesian_process_model = BayesianProcessModel(self.batch_size, self.num_ensemble, self.dim_x)
+
+        # learned sensor, observation and observation noise models of every stream
+        self.sensor_models = [BayesianImageSensorModel(self.batch_size, self.num_ensemble, self.dim_z,
+                                                       shared_features=shared_features)
+                              for _ in range (num_sensors)]
+        self.observation_models = [ObservationModel(self.batch_size, self.num_ensemble, self.dim_x, self.dim_z)
+                                   for _ in range (num_sensors)]
+        self.observation_noise_models = [ObservationNoise(self.batch_size, self.num_ensemble, self.dim_z, self.r_diag,
+                                                          dense=False, rank=noise_rank)
+                                         for _ in range (num_sensors)]
+
+        self.utils_ = utils()
+
+        self.set_update_mode(update_mode, noise_rank, filter_type)
+
+    def propagate(self, states):
+        state_old, m_state = states
+        num_ensemble = tf.shape(state_old)[1]
+        state_old = tf.reshape(state_old, [-1, num_ensemble, self.dim_x])
+
+        # get prediction and noise of next state
+        state_pred = self.bayesian_process_model(state_old)
+
+        m_state_pred = tf.reduce_mean(state_pred, axis = 1, keepdims = True)
+        return state_pred, m_state_pred
 
-        m_state_pred = tf.reshape(m_state_pred, [self.batch_size, 1, self.dim_x])
+    def correct(self, i, raw_sensor, states, observed=None):
+        state_pred, m_state = states
+        num_ensemble = tf.shape(state_pred)[1]
 
-        z = tf.reshape(z, [self.batch_size, 1, self.dim_z])
+        # get predicted observations, sensor reading and observation noise of sensor i
+        H_X = self.observation_models[i](state_pred)
+        ensemble_z, z, encoding = self.sensor_models[i](raw_sensor, num_ensemble = num_ensemble)
+        U_R, diag_R = self.observation_noise_models[i](encoding, True)
 
-        ensemble_z = tf.reshape(ensemble_z, [self.batch_size, self.num_ensemble, self.dim_z])
+        state_new = self.update(state_pred, H_X, ensemble_z, U_R, diag_R)
+        if observed is not None:
+            state_new = tf.where(tf.reshape(observed, [-1, 1, 1]), state_new, state_pred)
 
-        m = tf.reshape(m, [self.batch_size, 1, self.dim_z])
+        m_state_new = tf.reduce_mean(state_new, axis = 1, keepdims = True)
+        z = tf.reshape(z, [-1, 1, self.dim_z])
+        return state_new, m_state_new, z
+
+    def call(self, inputs, states, arrived):
+        states = self.propagate(states)
+        m_state_pred = states[1]
+        z = []
+        for i in range (self.num_sensors):
+            out = self.correct(i, inputs[i], states, arrived[:, i])
+            states = out[:2]
+            z.append(out[2])
 
         # tuple structure of updated state
-        output = (state_new, m_state_new, m_state_pred, z, ensemble_z, m)
+        output = (states[0], states[1], m_state_pred, tuple(z))
 
         return output
 
 
+class FilterStep:
+    '''
+    compiled train and test steps of an enKFMLP model, both are wrapped in a
+    tf.function with a fixed input signature (raw_sensor, (ensemble, m_state)),
+    so they are traced once and not retraced between steps.
+    sensor_spec is the tf.TensorSpec of raw_sensor (or a tuple of specs),
+    the batch and ensemble dimensions are left open, so one FilterStep serves
+    any batch size and the ensemble size can be picked per call
+    train_step(raw_sensor, states, gt_now) runs the forward pass, all losses
+    and the gradient updates, test_step(raw_sensor, states) runs one filter step,
+    rollout(observations, states) runs a whole sequence [T, ...] in one graph,
+    masked_rollout(observations, states, mask) runs trajectories of unequal
+    lengths packed into the batch (see DataLoader.pad_trajectories),
+    observed_step(raw_sensor, states, observed) is test_step with a [batch_size]
+    observation mask, masked elements only run the prediction
+    with jit_compile=True both steps are compiled with XLA, a step that cannot
+    be compiled raises an error instead of falling back to the plain graph
+    '''
+    def __init__(self, model, optimizer, sensor_spec, jit_compile=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.get_loss = getloss()
+        state_spec = (tf.TensorSpec([None, None, model.dim_x], tf.float32),
+                      tf.TensorSpec([None, 1, model.dim_x], tf.float32))
+        gt_spec = tf.TensorSpec([None, 1, model.dim_x], tf.float32)
+        self.train_step = tf.function(self.train, input_signature=[sensor_spec, state_spec, gt_spec],
+                                      experimental_compile=jit_compile)
+        self.test_step = tf.function(self.test, input_signature=[sensor_spec, state_spec],
+                                     experimental_compile=jit_compile)
+        sequence_spec = tf.nest.map_structure(
+            lambda spec: tf.TensorSpec([None] + spec.shape.as_list(), spec.dtype), sensor_spec)
+        self.rollout = tf.function(model.rollout, input_signature=[sequence_spec, state_spec],
+                                   experimental_compile=jit_compile)
+        mask_spec = tf.TensorSpec([None, None], tf.bool)
+        self.observed_step = tf.function(self.test_observed,
+                                         input_signature=[sensor_spec, state_spec, tf.TensorSpec([None], tf.bool)],
+                                         experimental_compile=jit_compile)
+        self.masked_rollout = tf.function(model.rollout, input_signature=[sequence_spec, state_spec, mask_spec],
+                                          experimental_compile=jit_compile)
+
+    def apply(self, tape, loss, model):
+        grads = tape.gradient(loss, model.trainable_weights)
+        self.optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+    def train(self, raw_sensor, states, gt_now):
+        with tf.GradientTape(persistent=True) as tape:
+            out = self.model(raw_sensor, states)
+            state_h = out[1]
+            state_p = out[2]
+            y = out[3]
+            # the observations are the velocities of the state, state[3:]
+            gt_z = gt_now[:, :, 3:]
+            loss_1 = self.get_loss._mse(gt_now - state_p)
+            loss_2 = self.get_loss._mse(gt_z - y)
+            m = out[5]
+            loss_3 = self.get_loss._mse(gt_z - m)
+            loss = self.get_loss._mse(gt_now - state_h)
+        self.apply(tape, loss, self.model)
+        self.apply(tape, loss_1, self.model.bayesian_process_model)
+        self.apply(tape, loss_2, self.model.sensor_model)
+        self.apply(tape, loss_3, self.model.observation_model)
+        del tape
+        return (loss, loss_1, loss_2, loss_3), out
+
+    def test(self, raw_sensor, states):
+        return self.model(raw_sensor, states)
+
+    def test_observed(self, raw_sensor, states, observed):
+        return self.model(raw_sensor, states, observed=observed)
+
+
+class SensorSchedule:
+    '''
+    arrival pattern of sensor streams with their own rates, the filter steps
+    at process_rate (Hz) and sensor i delivers rates[i] frames per second,
+    starting offsets[i] seconds in, a frame is used at the first process step
+    at or after its timestamp.
+    arrivals(T) returns arrived = [T, num_sensors] (bool)
+    '''
+    def __init__(self, process_rate, rates, offsets=None):
+        self.process_rate = process_rate
+        self.rates = rates
+        if offsets is None:
+            offsets = [0.] * len(rates)
+        self.offsets = offsets
+
+    def arrivals(self, T):
+        t = np.arange(T) / self.process_rate
+        arrived = []
+        for rate, offset in zip(self.rates, self.offsets):
+            # index of the latest frame delivered up to each process step
+            frame = np.floor((t - offset) * rate + 1e-6)
+            last = np.concatenate([[-1.], frame[:-1]])
+            arrived.append((frame > last) & (t >= offset))
+        return np.stack(arrived, axis=1)
+
+
+class MultiRateRunner:
+    '''
+    runs a MultiRateEnKF over streams that arrive at their own rates, the
+    prediction runs at every process step and the update of a sensor only
+    at the steps where it delivered a frame, so a slow stream costs nothing
+    in between. propagate and the correct step of every sensor are compiled
+    once, sensor_specs holds the tf.TensorSpec of each sensor's frames.
+    run(streams, states, arrived) reads streams[i][t] (the frame of sensor i
+    at process step t) only where arrived[t, i], and yields (ensemble, m_state)
+    after every process step.
+    train_step(inputs, states, gt_now, arrived) trains the model with optimizer
+    on one step of every sensor, arrived = [batch_size, num_sensors] (bool) is
+    the arrival mask of that step, the frames of sensors that did not deliver
+    are run but neither update the state nor count in their sensor loss
+    '''
+    def __init__(self, model, sensor_specs, jit_compile=False, optimizer=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.get_loss = getloss()
+        state_spec = (tf.TensorSpec([None, None, model.dim_x], tf.float32),
+                      tf.TensorSpec([None, 1, model.dim_x], tf.float32))
+        self.propagate = tf.function(model.propagate, input_signature=[state_spec],
+                                     experimental_compile=jit_compile)
+        self.correct = [self.compile_correct(i, sensor_specs[i], state_spec, jit_compile)
+                        for i in range (model.num_sensors)]
+        gt_spec = tf.TensorSpec([None, 1, model.dim_x], tf.float32)
+        arrived_spec = tf.TensorSpec([None, model.num_sensors], tf.bool)
+        self.train_step = tf.function(self.train,
+                                      input_signature=[tuple(sensor_specs), state_spec, gt_spec, arrived_spec],
+                                      experimental_compile=jit_compile)
+
+    def compile_correct(self, i, sensor_spec, state_spec, jit_compile):
+        def correct(raw_sensor, states):
+            return self.model.correct(i, raw_sensor, states)
+        return tf.function(correct, input_signature=[sensor_spec, state_spec],
+                           experimental_compile=jit_compile)
+
+    def apply(self, tape, loss, model):
+        grads = tape.gradient(loss, model.trainable_weights)
+        self.optimizer.apply_gradients(zip(grads, model.trainable_weights))
+
+    def train(self, inputs, states, gt_now, arrived):
+        with tf.GradientTape(persistent=True) as tape:
+            out = self.model(inputs, states, arrived)
+            state_h = out[1]
+            state_p = out[2]
+            loss = self.get_loss._mse(gt_now - state_h)
+            loss_1 = self.get_loss._mse(gt_now - state_p)
+            # the observations are the velocities of the state, state[3:],
+            # the elements without a frame of sensor i add nothing to its loss
+            gt_z = gt_now[:, :, 3:]
+            loss_2 = [self.get_loss._masked_mse(gt_z - out[3][i], arrived[:, i])
+                      for i in range (self.model.num_sensors)]
+        self.apply(tape, loss, self.model)
+        self.apply(tape, loss_1, self.model.bayesian_process_model)
+        for i in range (self.model.num_sensors):
+            self.apply(tape, loss_2[i], self.model.sensor_models[i])
+        del tape
+        return (loss, loss_1, tuple(loss_2)), out
+
+    def run(self, streams, states, arrived):
+        for t in range (arrived.shape[0]):
+            states = self.propagate(states)
+            for i in range (len(self.correct)):
+                if arrived[t, i]:
+                    states = self.correct[i](streams[i][t], states)[:2]
+            yield states
+
+
@@ -23,7 +23,7 @@ define the training loop
 def run_filter(mode):
 
     tf.keras.backend.clear_session()
-    dim_x = 2
+    dim_x = 5
     if mode == True:
         # define batch_size
         batch_size = 32
@@ -39,6 +39,9 @@ def run_filter(mode):
 
         optimizer = tf.keras.optimizers.Adam(learning_rate=1e-4)
 
+        # compiled forward pass, losses and updates, built for the first batch
+        filter_step = None
+
         epoch = 100
         for k in range (epoch):
             print('end-to-end wholemodel')
@@ -51,39 +54,27 @@ def run_filter(mode):
             for step in range(steps):
                 gt_pre, gt_now, raw_sensor_1, raw_sensor_2 = DataLoader.load_training_data(path_1, path_2, path_3, batch_size, name[index])
                 raw_sensor = (raw_sensor_1, raw_sensor_2)
-                with tf.GradientTape(persistent=True) as tape:
-                    start = time.time()
-                    states = DataLoader.format_state(gt_pre, batch_size, num_ensemble, dim_x)
-                    out = model(raw_sensor,states)
+                if filter_step is None:
+                    sensor_spec = tf.nest.map_structure(
+                        lambda x: tf.TensorSpec([None] + x.shape[1:].as_list(), x.dtype), raw_sensor)
+                    filter_step = diff_enKF.FilterStep(model, optimizer, sensor_spec)
+                start = time.time()
+                states = DataLoader.format_state(gt_pre, batch_size, num_ensemble, dim_x)
+                (loss, loss_1, loss_2, loss_3), out = filter_step.train_step(raw_sensor, states, gt_now)
+                end = time.time()
+                if step %50 ==0:
                     state_h = out[1]
                     state_p = out[2]
                     y = out[3]
                     m = out[5]
-                    loss_1 = get_loss._mse(gt_now - state_p)
-                    loss_2 = get_loss._mse(gt_now - y)
-                    loss_3 = get_loss._mse(gt_now - m)
-                    loss = get_loss._mse(gt_now - state_h)
-                    end = time.time()
-                    if step %50 ==0:
-                        print("Training loss at step %d: %.4f (took %.3f seconds) " %
-                              (step, float(loss), float(end-start)))
-                        print(state_p[0])
-                        print(m[0])
-                        print(y[0])
-                        print(state_h[0])
-                        print(gt_now[0])
-                        print('---')
-                grads = tape.gradient(loss, model.trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.trainable_weights))
-
-                grads = tape.gradient(loss_1, model.layers[0].trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.layers[0].trainable_weights))
-
-                grads = tape.gradient(loss_2, model.layers[3].trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.layers[3].trainable_weights))
-
-                grads = tape.gradient(loss_3, model.layers[1].trainable_weights)
-                optimizer.apply_gradients(zip(grads, model.layers[1].trainable_weights))
+                    print("Training loss at step %d: %.4f (took %.3f seconds) " %
+                          (step, float(loss), float(end-start)))
+                    print(state_p[0])
+                    print(m[0])
+                    print(y[0])
+                    print(state_h[0])
+                    print(gt_now[0])
+                    print('---')
 
             if (k+1) % epoch == 0:
                 model.save_weights('./models/DEnKF_'+version+'_'+name[index]+str(epoch).zfill(3)+'.h5')
@@ -95,27 +86,16 @@ def run_filter(mode):
                 # define batch_size
                 test_batch_size = 1
 
-                test_num_ensemble = 32
-
-                test_dropout_rate = 0.1
-
-                # load the model
-                model_test = diff_enKF.enKFMLP(test_batch_size, test_num_ensemble, test_dropout_rate)
+                test_num_ensemble = num_ensemble
 
+                # the model is evaluated as it is, no rebuild or weight reload
                 path_2 = './dataset/track_dataset_02.pkl'
 
                 test_gt_pre, test_gt_now, test_raw_sensor_1, test_raw_sensor_2 = DataLoader.load_testing_data(path_2, tracker_id[index])
 
                 # load init state
-                inputs = (test_raw_sensor_1[0], test_raw_sensor_2[0])
                 init_states = DataLoader.format_init_state(test_gt_pre[0], test_batch_size, test_num_ensemble, dim_x)
 
-                dummy = model_test(inputs, init_states)
-                model_test.load_weights('./models/DEnKF_'+version+'_'+name[index]+str(k).zfill(3)+'.h5')
-                for layer in model_test.layers:
-                    layer.trainable = False
-                model_test.summary()
-
                 '''
                 run a test demo and save the state of the test demo
                 '''
@@ -126,21 +106,19 @@ def run_filter(mode):
                 transition_save = []
                 observation_save = []
 
+                # the whole sequence is filtered in one graph and copied back at the end
+                out = filter_step.rollout((test_raw_sensor_1, test_raw_sensor_2), init_states)
+                out = [np.array(o) for o in out[:4]]
                 for t in range (test_gt_now.shape[0]):
-                    if t == 0:
-                        states = init_states
-                    test_raw_sensor = (test_raw_sensor_1[t], test_raw_sensor_2[t])
-                    out = model_test(test_raw_sensor, states)
                     if t%3 == 0:
                         print('---')
-                        print(out[1])
+                        print(out[1][t])
                         print(test_gt_now[t])
-                    states = (out[0], out[1])
-                    state_out = np.array(out[1])
+                    state_out = out[1][t]
                     gt_out = np.array(test_gt_now[t])
-                    ensemble = np.array(tf.reshape(out[0], [test_num_ensemble, dim_x]))
-                    transition_out = np.array(out[2])
-                    observation_out = np.array(out[3])
+                    ensemble = np.reshape(out[0][t], [test_num_ensemble, dim_x])
+                    transition_out = out[2][t]
+                    observation_out = out[3][t]
                     data_save.append(state_out)
                     emsemble_save.append(ensemble)
                     gt_save.append(gt_out)
@@ -181,11 +159,9 @@ def run_filter(mode):
             for layer in model_test.layers:
                 layer.trainable = False
             model_test.summary()
-
-            transition_model = diff_enKF.bayesiantransition(test_batch_size, test_num_ensemble, test_dropout_rate)
-            dummy = transition_model(init_states)
-            transition_model.set_weights(model_test.layers[0].get_weights())
-            transition_model.summary()
+            sensor_spec = tf.nest.map_structure(
+                lambda x: tf.TensorSpec([None] + x.shape[1:].as_list(), x.dtype), inputs)
+            filter_step = diff_enKF.FilterStep(model_test, None, sensor_spec)
 
             '''
             run a test demo and save the state of the test demo
@@ -197,21 +173,19 @@ def run_filter(mode):
             transition_save = []
             observation_save = []
 
+            # the whole sequence is filtered in one graph and copied back at the end
+            out = filter_step.rollout((test_raw_sensor_1, test_raw_sensor_2), init_states)
+            out = [np.array(o) for o in out[:4]]
             for t in range (test_gt_now.shape[0]):
-                if t == 0:
-                    states = init_states
-                test_raw_sensor = (test_raw_sensor_1[t], test_raw_sensor_2[t])
-                out = model_test(test_raw_sensor, states)
                 if t%3 == 0:
                     print('---')
-                    print(out[1])
+                    print(out[1][t])
                     print(test_gt_now[t])
-                states = (out[0], out[1])
-                state_out = np.array(out[1])
+                state_out = out[1][t]
                 gt_out = np.array(test_gt_now[t])
-                ensemble = np.array(tf.reshape(out[0], [test_num_ensemble, dim_x]))
-                transition_out = np.array(out[2])
-                observation_out = np.array(out[3])
+                ensemble = np.reshape(out[0][t], [test_num_ensemble, dim_x])
+                transition_out = out[2][t]
+                observation_out = out[3][t]
                 data_save.append(state_out)
                 emsemble_save.append(ensemble)
                 gt_save.append(gt_out)
@@ -239,11 +213,9 @@ def run_filter(mode):
                 if t == 0:
                     states = init_states
                 test_raw_sensor = (test_raw_sensor_1[t], test_raw_sensor_2[t])
-                draw = random.uniform(0, 1)
-                if draw >= 0.3:
-                    out = model_test(test_raw_sensor, states)
-                else:
-                    out = transition_model(states)
+                # about 30% of the observations are dropped, those steps only run the prediction
+                observed = np.random.uniform(0, 1, [test_batch_size]) >= 0.3
+                out = filter_step.observed_step(test_raw_sensor, states, observed)
                 if t%3 == 0:
                     print('---')
                     print(out[1])
@@ -268,6 +240,33 @@ def run_filter(mode):
 
             with open('./output/new_DEnKF_transition'+version+'_'+ name[index]+str(k).zfill(3)+'.pkl', 'wb') as f:
                 pickle.dump(data, f)
+
+            '''
+            run the test demos of all trackers together, one tracker per batch entry,
+            all of them with the weights trained for name[index]
+            '''
+            if not cross_eval:
+                continue
+            trajectories = [DataLoader.load_testing_data(path_2, tracker) for tracker in tracker_id]
+            lengths = [np.array(traj[1]).shape[0] for traj in trajectories]
+            # [T, 1, ...] per tracker -> [T_max, num_trackers, ...]
+            all_raw_sensor_1, mask = DataLoader.pad_trajectories([np.array(traj[2])[:, 0] for traj in trajectories])
+            all_raw_sensor_2, _ = DataLoader.pad_trajectories([np.array(traj[3])[:, 0] for traj in trajectories])
+            all_init = np.concatenate([np.reshape(traj[0][0], [1, 1, dim_x]) for traj in trajectories])
+            init_states = DataLoader.format_init_state(all_init, len(tracker_id), test_num_ensemble, dim_x)
+
+            out = filter_step.masked_rollout((all_raw_sensor_1, all_raw_sensor_2), init_states, mask)
+            out = [np.array(o) for o in out[:4]]
+            for i in range (len(tracker_id)):
+                data = {}
+                data['state'] = [out[1][t, i:i+1] for t in range (lengths[i])]
+                data['ensemble'] = [out[0][t, i] for t in range (lengths[i])]
+                data['gt'] = [np.array(trajectories[i][1][t]) for t in range (lengths[i])]
+                data['observation'] = [out[3][t, i:i+1] for t in range (lengths[i])]
+                data['transition'] = [out[2][t, i:i+1] for t in range (lengths[i])]
+
+                with open('./output/new_DEnKF_'+version+'_'+ name[index]+str(k).zfill(3)+'_on_'+tracker_id[i]+'.pkl', 'wb') as f:
+                    pickle.dump(data, f)
         
 '''
 load loss functions
@@ -289,6 +288,11 @@ index = 1
 
 global version
 version = 'v1.0'
+
+# also test the weights of name[index] on the trackers of every location,
+# saved as new_DEnKF_<version>_<name[index]><k>_on_<tracker>.pkl
+global cross_eval
+cross_eval = False
 old_version = version
 
 